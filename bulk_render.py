@@ -0,0 +1,150 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Offline renderer: feeds a CSV/JSONL manifest straight into the synthesis
+# core of main.py (parse_segments / PseudoConverter / generate_combined_audio)
+# without going through HTTP or billing.
+#
+#   python3 bulk_render.py script.csv -o out/ --workers 8 --engine-concurrency 4
+#
+# Each row needs `text`; `id`, `speaker`, `mode` and any other TTSRequest
+# field are optional. Finished ids are appended to <out>/progress.jsonl, so
+# re-running the same command resumes where the last run stopped.
+
+PROGRESS_FILE = "progress.jsonl"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render a CSV/JSONL script to WAV files without the HTTP layer")
+    parser.add_argument("manifest", help="input .csv (with header) or .jsonl")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("--speaker", type=int, default=3, help="default speaker when a row has none")
+    parser.add_argument("--mode", default="pseudo_jp", choices=["pseudo_jp", "raw"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--engine-concurrency", type=int, default=0, help="pin in-flight engine calls (0 = adaptive)")
+    parser.add_argument("--base-url", help="override VOICEVOX_BASE_URL")
+    return parser.parse_args()
+
+def read_manifest(path):
+    rows = []
+    with open(path, "r", encoding="utf-8-sig") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                rows.append({k: v for k, v in row.items() if k and v not in (None, "")})
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    rows.append(json.loads(line))
+    for idx, row in enumerate(rows, 1):
+        row["id"] = re.sub(r"[^\w.-]", "_", str(row.get("id") or f"{idx:06d}"))
+    return rows
+
+def load_progress(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn last line from a crash
+                if entry.get("status") == "ok":
+                    done.add(entry["id"])
+    return done
+
+def write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def wav_seconds(audio):
+    with wave.open(io.BytesIO(audio), "rb") as w:
+        return w.getnframes() / w.getframerate()
+
+def main():
+    args = parse_args()
+    os.environ["VOICEVOX_ENGINE_CONCURRENCY"] = str(args.engine_concurrency)
+    if args.base_url:
+        os.environ["VOICEVOX_BASE_URL"] = args.base_url
+    import main as core # reads the environment above at import time
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress_path = os.path.join(args.output_dir, PROGRESS_FILE)
+    rows = read_manifest(args.manifest)
+    done = load_progress(progress_path)
+    todo = [row for row in rows if row["id"] not in done]
+    print(f"{len(rows)} lines, {len(rows) - len(todo)} already rendered, {len(todo)} to go")
+
+    progress_lock = threading.Lock()
+    progress = open(progress_path, "a", encoding="utf-8")
+
+    def record(entry):
+        with progress_lock:
+            progress.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            progress.flush()
+
+    def render(row):
+        started = time.monotonic()
+        if not str(row.get("text", "")).strip():
+            raise ValueError("empty text")
+        params = core.TTSRequest(**{"speaker": args.speaker, "mode": args.mode, **row})
+        audio = core.generate_combined_audio(core.parse_segments(params.text, params.speaker), params, core.new_deadline(params.timeout))
+        if not audio:
+            raise RuntimeError("no audio produced")
+        write_atomic(os.path.join(args.output_dir, f"{row['id']}.wav"), audio)
+        return wav_seconds(audio), time.monotonic() - started
+
+    failures = []
+    audio_total = 0.0
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(render, row): row for row in todo}
+            for n, future in enumerate(as_completed(futures), 1):
+                row = futures[future]
+                try:
+                    seconds, took = future.result()
+                except Exception as e:
+                    detail = getattr(e, "detail", None) or str(e)
+                    failures.append((row["id"], detail))
+                    record({"id": row["id"], "status": "error", "error": detail})
+                    print(f"[{n}/{len(todo)}] {row['id']} FAILED: {detail}")
+                    continue
+                audio_total += seconds
+                record({"id": row["id"], "status": "ok", "audio_seconds": round(seconds, 3), "render_seconds": round(took, 3)})
+                print(f"[{n}/{len(todo)}] {row['id']} {seconds:.1f}s audio in {took:.1f}s")
+    finally:
+        progress.close()
+
+    elapsed = time.monotonic() - started
+    rendered = len(todo) - len(failures)
+    print("")
+    print(f"Rendered {rendered}/{len(todo)} lines in {elapsed:.1f}s "
+          f"({rendered / elapsed if elapsed else 0:.2f} lines/s, "
+          f"{audio_total / elapsed if elapsed else 0:.1f}x realtime, {audio_total:.1f}s audio)")
+    if failures:
+        print(f"{len(failures)} failed (re-run the same command to retry them):")
+        for line_id, detail in failures:
+            print(f"  {line_id}: {detail}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import sys
 import re
 import json
 import logging
@@ -6,21 +7,41 @@ import requests
 import uuid
 import subprocess
 import tempfile
+import shutil
 import hashlib
+import hmac
 import secrets
 import io
 import wave
+import base64
+import zipfile
+import asyncio
+import threading
+import time
+import mmap
+import fcntl
+import socket
+import struct
+import urllib.parse
+import email.utils
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 from typing import Optional, List, Dict
-from fastapi import FastAPI, HTTPException, Header, Depends, Request, File, UploadFile, Form
-from fastapi.responses import Response, HTMLResponse
+import numpy as np
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, File, UploadFile, Form, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from pypinyin import pinyin, Style, load_phrases_dict
-from sqlalchemy import Column, String, Integer, DateTime, create_engine
+from sqlalchemy import Column, String, Integer, Float, DateTime, create_engine, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
@@ -110,6 +131,57 @@ class Payment(Base):
     status = Column(String, default="PENDING") # PENDING, SUCCESS, FAILED
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class UsageEvent(Base):
+    __tablename__ = "usage_events"
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    api_key = Column(String, index=True)
+    endpoint = Column(String)
+    speaker = Column(Integer, index=True)
+    mode = Column(String)
+    chars = Column(Integer, default=0)
+    audio_seconds = Column(Float, default=0.0)
+    latency_ms = Column(Integer, default=0)
+    status = Column(Integer)
+    text_hash = Column(String, index=True)
+    text = Column(String, nullable=True) # only kept for short phrases
+    params = Column(String, nullable=True) # prosody JSON, to re-render hot phrases
+    rolled_up = Column(Integer, default=0, index=True) # 0 = pending, else the id of the rollup run that took it
+
+class UsageRollup(Base):
+    __tablename__ = "usage_rollups"
+    hour = Column(DateTime, primary_key=True)
+    api_key = Column(String, primary_key=True)
+    speaker = Column(Integer, primary_key=True)
+    requests = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    chars = Column(Integer, default=0)
+    audio_seconds = Column(Float, default=0.0)
+    latency_ms = Column(Integer, default=0) # sum; divide by requests for the mean
+
+class UrlSigningKey(Base):
+    # Public key id carried in signed URLs instead of the API key itself.
+    __tablename__ = "url_signing_keys"
+    kid = Column(String, primary_key=True, index=True)
+    api_key = Column(String, unique=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Document(Base):
+    __tablename__ = "documents"
+    id = Column(String, primary_key=True, index=True)
+    api_key = Column(String, index=True)
+    version = Column(Integer, default=1) # latest
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class DocumentVersion(Base):
+    __tablename__ = "document_versions"
+    document_id = Column(String, primary_key=True)
+    version = Column(Integer, primary_key=True)
+    params = Column(String) # TTSRequest JSON, text included
+    chunks = Column(String) # JSON [[hash, speaker, text], ...]
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 def hash_password(password: str, salt: str = None) -> (str, str):
     if not salt:
         salt = secrets.token_hex(16)
@@ -126,6 +198,58 @@ VOICEVOX_URL = os.getenv("VOICEVOX_BASE_URL", "https://voicevox.kira.de5.net").r
 ADMIN_KEY = os.getenv("VOICEVOX_ADMIN_KEY", "change_me_admin_key")
 PUBLIC_API_KEY = os.getenv("VOICEVOX_ADAPTER_KEY", "public_demo_key")
 BGM_FILE = os.getenv("VOICEVOX_BGM_FILE", os.path.join(BASE_DIR, "1.mp3"))
+# Engine capabilities; flipped off at runtime when the engine answers 404/405.
+ENGINE_FEATURES = {
+    "multi_synthesis": os.getenv("VOICEVOX_MULTI_SYNTHESIS", "1") != "0",
+    "connect_waves": os.getenv("VOICEVOX_ENGINE_CONNECT_WAVES", "0") == "1",
+}
+CACHE_BACKEND = os.getenv("VOICEVOX_CACHE_BACKEND", "memory") # memory | mmap | redis
+CACHE_DIR = os.getenv("VOICEVOX_CACHE_DIR", os.path.join(BASE_DIR, "cache"))
+CACHE_MB = int(os.getenv("VOICEVOX_CACHE_MB", "256"))
+REDIS_URL = os.getenv("VOICEVOX_REDIS_URL", "redis://127.0.0.1:6379/0")
+SPEAKER_CACHE_TTL = int(os.getenv("VOICEVOX_SPEAKER_CACHE_TTL", "3600"))
+# Upstream tail-latency control
+REQUEST_DEADLINE = float(os.getenv("VOICEVOX_REQUEST_DEADLINE", "60"))
+HEDGE_URLS = [u.strip().rstrip("/") for u in os.getenv("VOICEVOX_HEDGE_URLS", "").split(",") if u.strip()]
+HEDGE_ENABLED = os.getenv("VOICEVOX_HEDGE", "1") != "0"
+HEDGE_MIN_DELAY = float(os.getenv("VOICEVOX_HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MAX_RATIO = float(os.getenv("VOICEVOX_HEDGE_MAX_RATIO", "0.1"))
+BREAKER_ERROR_RATE = float(os.getenv("VOICEVOX_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.getenv("VOICEVOX_BREAKER_MIN_CALLS", "20"))
+BREAKER_WINDOW = float(os.getenv("VOICEVOX_BREAKER_WINDOW", "30"))
+BREAKER_COOLDOWN = float(os.getenv("VOICEVOX_BREAKER_COOLDOWN", "10"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("VOICEVOX_USAGE_FLUSH_INTERVAL", "1"))
+USAGE_ROLLUP_INTERVAL = float(os.getenv("VOICEVOX_USAGE_ROLLUP_INTERVAL", "300"))
+USAGE_RETENTION_DAYS = int(os.getenv("VOICEVOX_USAGE_RETENTION_DAYS", "30"))
+USAGE_PHRASE_MAX_CHARS = 200
+PREWARM_ENABLED = os.getenv("VOICEVOX_PREWARM", "1") != "0"
+PREWARM_STYLES = int(os.getenv("VOICEVOX_PREWARM_STYLES", "5"))
+PREWARM_PHRASES = int(os.getenv("VOICEVOX_PREWARM_PHRASES", "50"))
+PREWARM_LOOKBACK_DAYS = int(os.getenv("VOICEVOX_PREWARM_LOOKBACK_DAYS", "7"))
+HEALTH_INTERVAL = float(os.getenv("VOICEVOX_HEALTH_INTERVAL", "15"))
+CONVERT_WORKERS = int(os.getenv("VOICEVOX_CONVERT_WORKERS", str(os.cpu_count() or 1)))
+CONVERT_PARALLEL_MIN_CHARS = int(os.getenv("VOICEVOX_CONVERT_PARALLEL_MIN_CHARS", "5000"))
+CONVERT_MAX_MB = float(os.getenv("VOICEVOX_CONVERT_MAX_MB", "10"))
+BGM_MAX_MB = float(os.getenv("VOICEVOX_BGM_MAX_MB", "20"))
+BGM_MAX_SECONDS = float(os.getenv("VOICEVOX_BGM_MAX_SECONDS", "600"))
+BGM_CACHE_DIR = os.getenv("VOICEVOX_BGM_CACHE_DIR", os.path.join(BASE_DIR, "bgm_cache"))
+BGM_CACHE_MB = int(os.getenv("VOICEVOX_BGM_CACHE_MB", "500"))
+UPLOAD_CHUNK = 64 * 1024
+ENGINE_CONCURRENCY = int(os.getenv("VOICEVOX_ENGINE_CONCURRENCY", "0")) # >0 pins the limit, 0 = adaptive
+ENGINE_LIMIT_MIN = int(os.getenv("VOICEVOX_ENGINE_LIMIT_MIN", "2"))
+ENGINE_LIMIT_MAX = int(os.getenv("VOICEVOX_ENGINE_LIMIT_MAX", "64"))
+ENGINE_LIMIT_INITIAL = int(os.getenv("VOICEVOX_ENGINE_LIMIT_INITIAL", "2"))
+ENGINE_LIMIT_TOLERANCE = float(os.getenv("VOICEVOX_ENGINE_LIMIT_TOLERANCE", "1.5"))
+RESULT_DIR = os.getenv("VOICEVOX_RESULT_DIR", os.path.join(BASE_DIR, "results"))
+RESULT_TTL = int(os.getenv("VOICEVOX_RESULT_TTL", "3600"))
+SIGNED_URL_MAX_BYTES = 4096 # encoded path; proxies reject request lines over 8 KB
+RESULT_BATCH_SEGMENTS = 16
+DOCUMENT_DIR = os.getenv("VOICEVOX_DOCUMENT_DIR", os.path.join(BASE_DIR, "documents"))
+DOCUMENT_SWEEP_INTERVAL = float(os.getenv("VOICEVOX_DOCUMENT_SWEEP_INTERVAL", "600"))
+QUERY_HANDLE_TTL = int(os.getenv("VOICEVOX_QUERY_HANDLE_TTL", "1800"))
+URL_SIGNING_SECRET = os.getenv("VOICEVOX_URL_SIGNING_SECRET", ADMIN_KEY).encode("utf-8")
+SIGNED_URL_TTL = int(os.getenv("VOICEVOX_SIGNED_URL_TTL", str(7 * 86400)))
+SIGNED_URL_BUCKET = 86400 # expiries are rounded up to this, so re-minted URLs stay identical
 
 # --- Translations ---
 TRANSLATIONS = {}
@@ -136,7 +260,292 @@ try:
 except Exception as e:
     logging.error(f"Failed to load translations: {e}")
 
+# --- 缓存后端 ---
+# All caches (speaker metadata, converted text, segment audio) go through one
+# byte-oriented backend selected by VOICEVOX_CACHE_BACKEND:
+#   memory: per-process LRU
+#   mmap:   file-backed store shared by every worker on the host
+#   redis:  any Redis-protocol server, shared across nodes
+class MemoryCacheBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict() # key -> (value, expires_at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at and expires_at < time.time():
+                self._pop(key)
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            self._pop(key)
+            self.items[key] = (value, time.time() + ttl if ttl else 0)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+class MmapCacheBackend:
+    # One file per key under a sharded directory: an 8-byte expiry header
+    # followed by the value. Writers publish with an atomic rename, so
+    # readers just mmap whatever file is there without taking any lock.
+    HEADER = struct.Struct("<d")
+    SWEEP_EVERY = 256
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.writes = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                expires_at, = self.HEADER.unpack_from(mm)
+                if expires_at and expires_at < time.time():
+                    return None
+                value = mm[self.HEADER.size:]
+        except (FileNotFoundError, ValueError, struct.error):
+            return None
+        try:
+            os.utime(path) # mtime doubles as the LRU clock for the sweeper
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.HEADER.pack(time.time() + ttl if ttl else 0))
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Cache write failed: {e}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        self.writes += 1
+        if self.writes % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        # Only one worker sweeps at a time; the others skip this round.
+        with open(os.path.join(self.root, ".sweep.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            entries = []
+            total = 0
+            now = time.time()
+            for shard in os.scandir(self.root):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        st = entry.stat()
+                        if entry.name.startswith(".tmp-"):
+                            if st.st_mtime < now - 3600:
+                                os.unlink(entry.path)
+                            continue
+                        with open(entry.path, "rb") as f:
+                            expires_at, = self.HEADER.unpack(f.read(self.HEADER.size))
+                        if expires_at and expires_at < now:
+                            os.unlink(entry.path)
+                            continue
+                    except (OSError, struct.error):
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+class RedisCacheBackend:
+    # Minimal RESP client (GET/SET PX/DEL) with one connection per thread, so
+    # no client library is needed. Errors degrade to cache misses.
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=2)
+            conn = (sock, sock.makefile("rb"))
+            self.local.conn = conn
+            if self.password:
+                self._command("AUTH", self.password)
+            if self.db:
+                self._command("SELECT", str(self.db))
+        return conn
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body
+        if kind == b"-":
+            raise RuntimeError(body.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            return [self._read_reply(reader) for _ in range(int(body))]
+        raise RuntimeError(f"Unexpected Redis reply: {line[:20]!r}")
+
+    def _command(self, *args):
+        sock, reader = self._conn()
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        try:
+            sock.sendall(b"".join(parts))
+            return self._read_reply(reader)
+        except (OSError, ConnectionError):
+            self.local.conn = None
+            sock.close()
+            raise
+
+    def get(self, key):
+        try:
+            return self._command("GET", key)
+        except Exception as e:
+            logging.error(f"Redis GET failed: {e}")
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            if ttl:
+                self._command("SET", key, value, "PX", int(ttl * 1000))
+            else:
+                self._command("SET", key, value)
+        except Exception as e:
+            logging.error(f"Redis SET failed: {e}")
+
+    def delete(self, key):
+        try:
+            self._command("DEL", key)
+        except Exception as e:
+            logging.error(f"Redis DEL failed: {e}")
+
+def create_cache_backend():
+    if CACHE_BACKEND == "mmap":
+        return MmapCacheBackend(CACHE_DIR, CACHE_MB * 1024 * 1024)
+    if CACHE_BACKEND == "redis":
+        return RedisCacheBackend(REDIS_URL)
+    return MemoryCacheBackend(CACHE_MB * 1024 * 1024)
+
+CACHE = create_cache_backend()
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadSizeLimit:
+    # Turns away /tts_custom bodies larger than the BGM limit (plus room for
+    # the text fields): from Content-Length before anything is read, and for
+    # chunked bodies by counting bytes as they arrive, so Starlette never
+    # spools more than the limit.
+    def __init__(self, app, path, max_bytes):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            await self.reject(scope, receive, send)
+            return
+        state = {"received": 0, "too_large": False, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > self.max_bytes:
+                    state["too_large"] = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            # Whatever the app makes of the aborted body is replaced by 413.
+            if state["too_large"]:
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not state["too_large"]:
+                raise
+        if state["too_large"] and not state["started"]:
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope, receive, send):
+        response = JSONResponse({"detail": f"BGM file exceeds {BGM_MAX_MB:g} MB"}, status_code=413)
+        await response(scope, receive, send)
+
 app = FastAPI()
+app.add_middleware(UploadSizeLimit, path="/tts_custom", max_bytes=int(BGM_MAX_MB * 1024 * 1024) + UPLOAD_CHUNK * 16)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_headers=["*"], allow_methods=["*"])
 static_dir = os.getenv("VOICEVOX_STATIC_DIR", os.path.join(BASE_DIR, "static"))
 os.makedirs(static_dir, exist_ok=True)
@@ -221,17 +630,123 @@ def public_config():
 
 @app.get("/debug_convert")
 def debug_convert(text: str, mode: str = "pseudo_jp"):
-    converted = converter.convert(text) if mode == "pseudo_jp" else text
+    converted = convert_text(text) if mode == "pseudo_jp" else text
     return {"mode": mode, "input": text, "output": converted}
 
+# --- 性能诊断 ---
+# Per-request phase timings, reported in the Server-Timing header.
+REQUEST_TIMINGS = contextvars.ContextVar("request_timings", default=None)
+
+def start_request_timing():
+    timings = {}
+    REQUEST_TIMINGS.set(timings)
+    PROFILER.note_request()
+    return timings
+
+@contextmanager
+def timed(name):
+    timings = REQUEST_TIMINGS.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def server_timing_header(timings):
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+def require_admin(x_admin_key: Optional[str] = Header(None)):
+    if not x_admin_key or not secrets.compare_digest(x_admin_key, ADMIN_KEY):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+class SamplingProfiler:
+    # Samples every thread's Python stack at a fixed interval and counts
+    # folded stacks ("root;...;leaf count"), the input format of
+    # flamegraph.pl / speedscope. By default only stacks that pass through
+    # this module are kept, which drops idle pool and event-loop threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counts = {}
+        self.requests_seen = 0
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, max_requests, interval, all_threads):
+        with self.lock:
+            if self.running():
+                return False
+            self.counts = {}
+            self.requests_seen = 0
+            self.thread = threading.Thread(
+                target=self._run, args=(seconds, max_requests, interval, all_threads), daemon=True, name="profiler"
+            )
+            self.thread.start()
+            return True
+
+    def note_request(self):
+        if self.running():
+            self.requests_seen += 1
+
+    def _run(self, seconds, max_requests, interval, all_threads):
+        own = threading.get_ident()
+        this_file = os.path.abspath(__file__)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not (max_requests and self.requests_seen >= max_requests):
+            for tid, frame in sys._current_frames().items():
+                if tid == own:
+                    continue
+                stack = []
+                relevant = all_threads
+                while frame is not None:
+                    code = frame.f_code
+                    relevant = relevant or code.co_filename == this_file
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if relevant:
+                    key = ";".join(reversed(stack))
+                    self.counts[key] = self.counts.get(key, 0) + 1
+            time.sleep(interval)
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+PROFILER = SamplingProfiler()
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(
+    seconds: float = 10, max_requests: int = Query(0, alias="requests"), interval_ms: float = 5, all_threads: bool = False
+):
+    # Profiles for `seconds`, or until `requests` synthesis requests have
+    # been served when that is non-zero; returns folded stacks.
+    seconds = min(max(seconds, 0.1), 300)
+    if not PROFILER.start(seconds, max_requests, max(interval_ms, 1) / 1000, all_threads):
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    while PROFILER.running():
+        await asyncio.sleep(0.1)
+    return PlainTextResponse(PROFILER.folded())
+
 # --- 缓存 ---
 SPEAKER_STYLE_MAP = {} # { uuid: { name: id } }
 STYLE_ID_TO_UUID = {} # { id: uuid }
 
-def refresh_speaker_cache():
+def fetch_speakers(force: bool = False):
+    if not force:
+        cached = CACHE.get("speakers")
+        if cached is not None:
+            return json.loads(cached)
+    speakers = requests.get(f"{VOICEVOX_URL}/speakers", verify=False).json()
+    CACHE.set("speakers", json.dumps(speakers, ensure_ascii=False).encode("utf-8"), SPEAKER_CACHE_TTL)
+    return speakers
+
+def refresh_speaker_cache(force: bool = False):
     global SPEAKER_STYLE_MAP, STYLE_ID_TO_UUID
     try:
-        speakers = requests.get(f"{VOICEVOX_URL}/speakers", verify=False).json()
+        speakers = fetch_speakers(force)
         for spk in speakers:
             uuid = spk["speaker_uuid"]
             styles = {}
@@ -350,6 +865,165 @@ class PseudoConverter:
 
 converter = PseudoConverter()
 
+def convert_cache_key(text: str) -> str:
+    return "conv:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def convert_text(text: str) -> str:
+    key = convert_cache_key(text)
+    cached = CACHE.get(key)
+    if cached is not None:
+        return cached.decode("utf-8")
+    converted = converter.convert(text)
+    CACHE.set(key, converted.encode("utf-8"))
+    return converted
+
+# --- 并行转换 ---
+# PseudoConverter is CPU-bound pypinyin work, so large inputs are spread over
+# a process pool. Texts are only cut right after a character that forms its
+# own pass-through token (punctuation, spaces, kana...), which keeps the
+# output identical to converting the whole text at once.
+CONVERT_SPLIT_RE = re.compile(r"[^a-zA-Z0-9\u4e00-\u9fff]")
+CONVERT_CHUNK_CHARS = 2000
+_CONVERT_POOL = None
+_CONVERT_POOL_LOCK = threading.Lock()
+
+def get_convert_pool():
+    global _CONVERT_POOL
+    with _CONVERT_POOL_LOCK:
+        if _CONVERT_POOL is None:
+            # fork keeps workers from re-importing this module (and re-running
+            # its DB/engine start-up side effects).
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("fork") if "fork" in methods else None
+            _CONVERT_POOL = ProcessPoolExecutor(max_workers=CONVERT_WORKERS, mp_context=ctx)
+        return _CONVERT_POOL
+
+def convert_many(texts):
+    # Process-pool entry point; deliberately bypasses CACHE (its locks are not
+    # safe to use in a forked child).
+    return [converter.convert(t) for t in texts]
+
+def split_for_conversion(text, size=CONVERT_CHUNK_CHARS):
+    pieces = []
+    start = 0
+    while len(text) - start > size:
+        m = CONVERT_SPLIT_RE.search(text, start + size)
+        if not m:
+            break
+        pieces.append(text[start:m.end()])
+        start = m.end()
+    pieces.append(text[start:])
+    return pieces
+
+def batch_by_chars(texts, size=CONVERT_CHUNK_CHARS):
+    batch, chars = [], 0
+    for text in texts:
+        batch.append(text)
+        chars += len(text)
+        if chars >= size:
+            yield batch
+            batch, chars = [], 0
+    if batch:
+        yield batch
+
+def convert_texts(texts):
+    # convert_text for many texts at once; cache misses totalling more than
+    # CONVERT_PARALLEL_MIN_CHARS are converted on the process pool.
+    results = [None] * len(texts)
+    misses = []
+    for idx, text in enumerate(texts):
+        cached = CACHE.get(convert_cache_key(text))
+        if cached is not None:
+            results[idx] = cached.decode("utf-8")
+        else:
+            misses.append(idx)
+    if not misses:
+        return results
+    if CONVERT_WORKERS <= 1 or sum(len(texts[i]) for i in misses) < CONVERT_PARALLEL_MIN_CHARS:
+        for idx in misses:
+            results[idx] = convert_text(texts[idx])
+        return results
+    pieces_per_text = [split_for_conversion(texts[i]) for i in misses]
+    flat = [piece for pieces in pieces_per_text for piece in pieces]
+    converted = iter([out for outs in get_convert_pool().map(convert_many, batch_by_chars(flat)) for out in outs])
+    for idx, pieces in zip(misses, pieces_per_text):
+        results[idx] = "".join(next(converted) for _ in pieces)
+        CACHE.set(convert_cache_key(texts[idx]), results[idx].encode("utf-8"))
+    return results
+
+async def read_bulk_lines(request: Request):
+    # JSON {"lines": [...]} / {"text": "..."}, a multipart "file" field, or a
+    # raw text/plain body; returns (lines, mode).
+    content_type = request.headers.get("content-type", "")
+    mode = request.query_params.get("mode", "pseudo_jp")
+    max_bytes = int(CONVERT_MAX_MB * 1024 * 1024)
+    if int(request.headers.get("content-length") or 0) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Input exceeds {CONVERT_MAX_MB:g} MB")
+    if content_type.startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail='JSON body must be an object with "lines" or "text"')
+        mode = body.get("mode", mode)
+        if "lines" in body:
+            if not isinstance(body["lines"], list):
+                raise HTTPException(status_code=400, detail='"lines" must be a list')
+            return [str(line) for line in body["lines"]], mode
+        return str(body.get("text", "")).splitlines(), mode
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        mode = form.get("mode", mode)
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing file field")
+        data = await upload.read(max_bytes + 1)
+    else:
+        data = await request.body()
+    if len(data) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Input exceeds {CONVERT_MAX_MB:g} MB")
+    return data.decode("utf-8-sig", "replace").splitlines(), mode
+
+@app.post("/convert_bulk")
+async def convert_bulk(request: Request):
+    # Streams one NDJSON object per input line, in input order.
+    lines, mode = await read_bulk_lines(request)
+    loop = asyncio.get_running_loop()
+
+    async def results():
+        if mode != "pseudo_jp":
+            for idx, line in enumerate(lines):
+                yield json.dumps({"index": idx, "input": line, "output": line}, ensure_ascii=False) + "\n"
+            return
+        pool = get_convert_pool()
+        batches = iter(batch_by_chars(lines))
+        inflight = deque()
+        idx = 0
+        while True:
+            while len(inflight) < CONVERT_WORKERS * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                inflight.append((batch, loop.run_in_executor(pool, convert_many, batch)))
+            if not inflight:
+                return
+            batch, future = inflight.popleft()
+            for line, output in zip(batch, await future):
+                yield json.dumps({"index": idx, "input": line, "output": output}, ensure_ascii=False) + "\n"
+                idx += 1
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+# Output rates are resampled locally with a polyphase filter whose size
+# grows with the reduced up/down ratio, so only standard rates are accepted.
+OUTPUT_SAMPLING_RATES = (8000, 11025, 16000, 22050, 24000, 32000, 44100, 48000, 88200, 96000, 192000)
+
+def check_sampling_rate(rate):
+    if rate is not None and rate not in OUTPUT_SAMPLING_RATES:
+        raise ValueError(f"outputSamplingRate must be one of {', '.join(map(str, OUTPUT_SAMPLING_RATES))}")
+    return rate
+
 class TTSRequest(BaseModel):
     text: str
     speaker: int
@@ -367,13 +1041,17 @@ class TTSRequest(BaseModel):
     pauseLengthScale: Optional[float] = 1.0
     bgmEnabled: Optional[bool] = False
     bgmVolume: Optional[float] = 0.5
+    timeout: Optional[float] = None
+    result: Optional[bool] = False
+
+    _check_sampling_rate = validator("outputSamplingRate", allow_reuse=True)(check_sampling_rate)
 
 def parse_segments(text, default_speaker_id):
     if not SPEAKER_STYLE_MAP:
         refresh_speaker_cache()
     current_uuid = STYLE_ID_TO_UUID.get(default_speaker_id)
     if not current_uuid:
-        refresh_speaker_cache()
+        refresh_speaker_cache(force=True)
         current_uuid = STYLE_ID_TO_UUID.get(default_speaker_id)
     text = text.strip()
     if not text:
@@ -432,6 +1110,10 @@ def mix_with_bgm(tts_audio: bytes, bgm_volume: float = 0.5, bgm_path: Optional[s
     bgm_src = bgm_path or BGM_FILE
     if not tts_audio or not bgm_src or not os.path.exists(bgm_src):
         return tts_audio
+    with timed("bgm"):
+        return _mix_with_bgm(tts_audio, bgm_volume, bgm_src)
+
+def _mix_with_bgm(tts_audio: bytes, bgm_volume: float, bgm_src: str) -> bytes:
     temp_files = []
     try:
         tts_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
@@ -443,20 +1125,7 @@ def mix_with_bgm(tts_audio: bytes, bgm_volume: float = 0.5, bgm_path: Optional[s
         out_file.close()
         temp_files.append(out_file.name)
 
-        subprocess.run(
-            [
-                "ffmpeg", "-y",
-                "-stream_loop", "-1", "-i", bgm_src,
-                "-i", tts_file.name,
-                "-filter_complex", f"[0:a]volume={bgm_volume}[bgm];[bgm][1:a]amix=inputs=2:duration=shortest:dropout_transition=2[out]",
-                "-map", "[out]",
-                "-ac", "1",
-                out_file.name,
-            ],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-        )
+        run_bgm_mix(tts_file.name, out_file.name, bgm_volume, bgm_src)
         with open(out_file.name, "rb") as f:
             return f.read()
     except Exception as e:
@@ -467,71 +1136,612 @@ def mix_with_bgm(tts_audio: bytes, bgm_volume: float = 0.5, bgm_path: Optional[s
             if os.path.exists(f):
                 os.unlink(f)
 
-def generate_combined_audio(segments, params):
+def run_bgm_mix(tts_path, out_path, bgm_volume, bgm_src):
+    subprocess.run(
+        [
+            "ffmpeg", "-y",
+            "-stream_loop", "-1", "-i", bgm_src,
+            "-i", tts_path,
+            "-filter_complex", f"[0:a]volume={bgm_volume}[bgm];[bgm][1:a]amix=inputs=2:duration=shortest:dropout_transition=2[out]",
+            "-map", "[out]",
+            "-ac", "1",
+            out_path,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+def segment_cache_key(spk_id, target_text, params):
+    # Output rate and channel layout are deliberately not part of the key.
+    fields = [
+        spk_id, target_text,
+        params.speedScale, params.pitchScale, params.intonationScale, params.volumeScale,
+        params.prePhonemeLength, params.postPhonemeLength,
+        getattr(params, "kana", None) or None,
+        getattr(params, "pauseLength", None),
+        getattr(params, "pauseLengthScale", None),
+    ]
+    return "audio:" + hashlib.sha256(json.dumps(fields, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+@lru_cache(maxsize=32)
+def polyphase_filter(up, down):
+    # Kaiser-windowed sinc low-pass at the narrower of the two Nyquist bands,
+    # split into `up` phases of equal length (rows of the returned matrix).
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    n = np.arange(-half_len, half_len + 1)
+    h = np.sinc(n / max_rate) / max_rate * np.kaiser(len(n), 5.0) * up
+    taps = -(-len(h) // up)
+    h = np.concatenate([h, np.zeros(taps * up - len(h))])
+    return h.reshape(taps, up).T.copy(), half_len
+
+def resample_poly(samples, up, down, block=16384):
+    if up == down:
+        return samples.astype(np.float64)
+    bank, half_len = polyphase_filter(up, down)
+    taps = bank.shape[1]
+    x = np.concatenate([np.zeros(taps), samples.astype(np.float64), np.zeros(taps)])
+    n_out = -(-len(samples) * up // down)
+    out = np.empty(n_out)
+    k = np.arange(taps)
+    for start in range(0, n_out, block):
+        m = np.arange(start, min(start + block, n_out))
+        pos = m * down + half_len
+        base = pos // up + taps
+        phase = pos % up
+        out[start:start + len(m)] = np.einsum("ij,ij->i", bank[phase], x[base[:, None] - k])
+    return out
+
+def convert_wav_format(wav_bytes, rate=None, stereo=False):
+    with wave.open(io.BytesIO(wav_bytes), "rb") as w:
+        params = w.getparams()
+        frames = w.readframes(params.nframes)
+    target_rate = rate or params.framerate
+    target_channels = 2 if stereo else 1
+    if params.framerate == target_rate and params.nchannels == target_channels:
+        return wav_bytes
+    if params.sampwidth != 2:
+        logging.error(f"Cannot convert {params.sampwidth * 8}-bit WAV, returning engine output")
+        return wav_bytes
+    samples = np.frombuffer(frames, dtype="<i2").reshape(-1, params.nchannels)
+    mono = samples[:, 0] if params.nchannels == 1 else samples.mean(axis=1)
+    if params.framerate != target_rate:
+        g = np.gcd(params.framerate, target_rate)
+        mono = resample_poly(mono, target_rate // g, params.framerate // g)
+        mono = np.clip(np.rint(mono), -32768, 32767)
+    mono = mono.astype("<i2")
+    # Stereo is a broadcast view of the mono track; the only copy is the
+    # interleaving done by tobytes().
+    out_frames = np.broadcast_to(mono[:, None], (len(mono), target_channels)).tobytes()
+    out_buf = io.BytesIO()
+    with wave.open(out_buf, "wb") as out_wav:
+        out_wav.setnchannels(target_channels)
+        out_wav.setsampwidth(2)
+        out_wav.setframerate(target_rate)
+        out_wav.writeframes(out_frames)
+    return out_buf.getvalue()
+
+# --- 引擎调用：截止时间 / 对冲请求 / 熔断 ---
+class EngineError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+@app.exception_handler(EngineError)
+def engine_error_handler(request: Request, exc: EngineError):
+    logging.error(f"Engine error on {request.url.path}: {exc.detail}")
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+class LatencyTracker:
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < 20:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+class CircuitBreaker:
+    # Opens when the error rate over the last BREAKER_WINDOW seconds exceeds
+    # BREAKER_ERROR_RATE; after BREAKER_COOLDOWN a single probe is let through
+    # and its outcome decides whether to close again.
+    def __init__(self):
+        self.outcomes = deque() # (timestamp, ok)
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if not self.open_until:
+                return True
+            if time.monotonic() < self.open_until or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def release_probe(self):
+        # For a call let through by allow() that ended without telling us
+        # anything about the engine; the next call may probe instead.
+        with self.lock:
+            self.probing = False
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self.lock:
+            if self.open_until:
+                if ok:
+                    self.open_until = 0.0
+                    self.outcomes.clear()
+                    logging.warning("Engine circuit closed")
+                else:
+                    self.open_until = now + BREAKER_COOLDOWN
+                self.probing = False
+                return
+            self.outcomes.append((now, ok))
+            while self.outcomes and self.outcomes[0][0] < now - BREAKER_WINDOW:
+                self.outcomes.popleft()
+            failures = sum(1 for _, o in self.outcomes if not o)
+            if len(self.outcomes) >= BREAKER_MIN_CALLS and failures / len(self.outcomes) > BREAKER_ERROR_RATE:
+                self.open_until = now + BREAKER_COOLDOWN
+                logging.error(f"Engine circuit opened: {failures}/{len(self.outcomes)} calls failed")
+
+    def state(self):
+        with self.lock:
+            if not self.open_until:
+                return "closed"
+            return "half_open" if time.monotonic() >= self.open_until else "open"
+
+class AdaptiveLimiter:
+    # Caps in-flight engine calls (AIMD driven by latency). Latency on this
+    # engine depends mostly on how much text a call carries, so each call is
+    # compared with the mean latency of calls of similar size on the same
+    # path (size classes are powers of two of characters / moras), and the
+    # congestion signal is the median of that ratio over the last WINDOW
+    # calls. The means settle over the first calls of each class, taken at
+    # the small initial limit on an idle engine, and then move only slowly.
+    # The limit grows by one per call until the first congestion signal,
+    # then by about one per limit's worth of calls while the median ratio
+    # stays within tolerance. Once the engine starts queueing internally
+    # (the ratio goes above that) or calls fail, the limit is cut
+    # multiplicatively, at most once per limit's worth of calls so a single
+    # congestion episode is not counted many times.
+    # Waiters are served first come first served, slots being handed over
+    # directly on release; low priority callers (prewarm) only get a slot
+    # when no high priority caller is waiting.
+    WINDOW = 20
+    MIN_SAMPLES = 10
+    BASELINE_ALPHA = 0.002
+    BACKOFF = 0.7
+
+    def __init__(self, initial, min_limit, max_limit, tolerance, fixed=False):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.fixed = fixed
+        self.in_flight = 0
+        self.queues = {"high": deque(), "low": deque()}
+        self.baseline = {} # (path, size class) -> [calls, mean latency]
+        self.ratios = deque(maxlen=self.WINDOW)
+        self.since_decrease = 0
+        self.slow_start = not fixed
+        self.stats = {"acquired": 0, "rejected": 0, "drops": 0}
+        self.lock = threading.Lock()
+
+    def _dispatch(self):
+        # Hand free slots to the oldest waiters, high priority first.
+        while self.in_flight < int(self.limit):
+            queue = self.queues["high"] or self.queues["low"]
+            if not queue:
+                return
+            waiter = queue.popleft()
+            waiter["granted"] = True
+            self.in_flight += 1
+            self.stats["acquired"] += 1
+            waiter["event"].set()
+
+    def acquire(self, priority, timeout):
+        # False if no slot freed up within `timeout` seconds.
+        waiter = {"granted": False, "event": threading.Event()}
+        with self.lock:
+            self.queues[priority].append(waiter)
+            self._dispatch()
+        waiter["event"].wait(max(0.0, timeout))
+        with self.lock:
+            if waiter["granted"]:
+                return True
+            self.queues[priority].remove(waiter)
+            self.stats["rejected"] += 1
+            return False
+
+    def try_acquire(self, priority):
+        # Takes a slot only if one is free and nobody is queued for it.
+        with self.lock:
+            if self.queues["high"] or self.queues[priority] or self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            self.stats["acquired"] += 1
+            return True
+
+    def release(self, path, seconds, ok, work=1):
+        with self.lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if not self.fixed:
+                self.since_decrease += 1
+                if ok:
+                    self._on_sample(path, seconds, in_flight, work)
+                else:
+                    self.stats["drops"] += 1
+                    self._decrease(self.BACKOFF)
+            self._dispatch()
+
+    def _decrease(self, factor):
+        if self.since_decrease >= self.limit:
+            self.since_decrease = 0
+            self.slow_start = False
+            self.limit = max(self.min_limit, self.limit * factor)
+
+    def _on_sample(self, path, seconds, in_flight, work):
+        baseline = self.baseline.setdefault((path, int(work).bit_length()), [0, 0.0])
+        if baseline[0] < self.MIN_SAMPLES:
+            # Plain mean over a class's first calls; until then the call
+            # neither signals congestion nor lets the limit grow.
+            baseline[0] += 1
+            baseline[1] += (seconds - baseline[1]) / baseline[0]
+            return
+        self.ratios.append(seconds / baseline[1] if baseline[1] > 0 else 1.0)
+        if len(self.ratios) < self.MIN_SAMPLES:
+            return
+        ratio = sorted(self.ratios)[len(self.ratios) // 2]
+        # Means keep learning only while calls run close to them (not while
+        # congestion builds, which would ratchet them up), or at the minimum
+        # limit so a truly slower engine is picked up eventually.
+        if ratio <= (1 + self.tolerance) / 2 or self.limit <= self.min_limit:
+            baseline[1] += (seconds - baseline[1]) * self.BASELINE_ALPHA
+        if ratio > self.tolerance:
+            self._decrease(max(0.5, self.tolerance / ratio))
+        elif in_flight * 2 >= self.limit:
+            # Only probe upwards when the current limit is actually used.
+            self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queued_high": len(self.queues["high"]),
+                "queued_low": len(self.queues["low"]),
+                **self.stats,
+            }
+
+ENGINE_LATENCY = {}
+ENGINE_BREAKER = CircuitBreaker()
+# Every task on the pool already holds a limiter slot, so it never needs
+# more workers than the largest possible limit.
+HEDGE_POOL = ThreadPoolExecutor(max_workers=max(ENGINE_LIMIT_MAX, ENGINE_CONCURRENCY), thread_name_prefix="engine")
+HEDGE_STATS = {"calls": 0, "hedges": 0}
+ENGINE_LIMITER = (
+    AdaptiveLimiter(ENGINE_CONCURRENCY, ENGINE_CONCURRENCY, ENGINE_CONCURRENCY, ENGINE_LIMIT_TOLERANCE, fixed=True)
+    if ENGINE_CONCURRENCY > 0 else
+    AdaptiveLimiter(ENGINE_LIMIT_INITIAL, ENGINE_LIMIT_MIN, ENGINE_LIMIT_MAX, ENGINE_LIMIT_TOLERANCE)
+)
+# Background work (prewarm) runs at "low" and yields slots to requests.
+ENGINE_PRIORITY = contextvars.ContextVar("engine_priority", default="high")
+
+@contextmanager
+def engine_priority(priority):
+    token = ENGINE_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        ENGINE_PRIORITY.reset(token)
+
+def new_deadline(seconds: Optional[float] = None) -> float:
+    return time.monotonic() + (seconds or REQUEST_DEADLINE)
+
+def engine_work(kwargs):
+    # Rough size of an engine call (characters, moras or wave bytes) for the
+    # limiter, which compares latencies only between calls of similar size.
+    body = kwargs.get("json")
+    if body is None:
+        return len((kwargs.get("params") or {}).get("text") or "") or 1
+    work = 0
+    for item in body if isinstance(body, list) else [body]:
+        if isinstance(item, dict):
+            work += sum(len(ap.get("moras") or []) for ap in item.get("accent_phrases") or [])
+        else:
+            work += len(item) // 1024
+    return work or 1
+
+def _engine_post(base_url, path, deadline, **kwargs):
+    # Runs on HEDGE_POOL with a limiter slot taken by the caller; gives it back.
+    work = engine_work(kwargs)
+    started = time.monotonic()
+    ok = False
+    try:
+        res = requests.post(f"{base_url}{path}", timeout=max(0.001, deadline - time.monotonic()), verify=False, **kwargs)
+        ok = res.status_code < 500
+        return res
+    finally:
+        ENGINE_LIMITER.release(path, time.monotonic() - started, ok, work)
+
+def engine_post(path, deadline, hedge=True, **kwargs):
+    # POST to the engine within `deadline` (a time.monotonic() value). If the
+    # call is slower than this path's p95, a duplicate goes to the next
+    # hedge engine (or the same one) and whichever answers first wins.
+    # Only used for idempotent calls (audio_query / synthesis).
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise EngineError(504, f"Deadline exceeded before {path}")
+    if not ENGINE_BREAKER.allow():
+        raise EngineError(503, "Engine temporarily unavailable (circuit open)")
+    # From here on every exit must record an outcome or hand the half-open
+    # probe back, otherwise the breaker stays open for good.
+    recorded = False
+    try:
+        tracker = ENGINE_LATENCY.setdefault(path, LatencyTracker())
+        HEDGE_STATS["calls"] += 1
+        # Queue for a slot on the caller's thread, so waiters show up in the
+        # queue depth and are served in order; pool threads never wait.
+        if not ENGINE_LIMITER.acquire(ENGINE_PRIORITY.get(), remaining):
+            # Timed out in our own queue: not an engine failure, so the
+            # outcome is left unrecorded and the probe handed back below.
+            raise EngineError(504, f"No engine slot for {path} before the deadline")
+        started = time.monotonic()
+        remaining = deadline - started
+        futures = {HEDGE_POOL.submit(_engine_post, VOICEVOX_URL, path, deadline, **kwargs)}
+        p95 = tracker.percentile(0.95)
+        hedge_delay = max(HEDGE_MIN_DELAY, p95) if p95 is not None else None
+        if hedge and HEDGE_ENABLED and hedge_delay is not None and hedge_delay < remaining:
+            done, _ = wait(futures, timeout=hedge_delay)
+            # A hedge only goes out if a slot is free right now; queueing it
+            # behind other callers would just add load when the engine is
+            # already saturated.
+            if (not done and HEDGE_STATS["hedges"] < HEDGE_STATS["calls"] * HEDGE_MAX_RATIO
+                    and ENGINE_LIMITER.try_acquire(ENGINE_PRIORITY.get())):
+                HEDGE_STATS["hedges"] += 1
+                urls = HEDGE_URLS or [VOICEVOX_URL]
+                hedge_url = urls[HEDGE_STATS["hedges"] % len(urls)]
+                futures.add(HEDGE_POOL.submit(_engine_post, hedge_url, path, deadline, **kwargs))
+        last_error = None
+        response = None
+        while futures and response is None:
+            done, futures = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    res = future.result()
+                except requests.RequestException as e:
+                    last_error = e
+                    continue
+                if res.status_code < 500:
+                    response = res
+                    break
+                last_error = EngineError(502, f"{path} failed: {res.status_code} {res.text[:200]}")
+        if response is not None:
+            tracker.record(time.monotonic() - started)
+            ENGINE_BREAKER.record(True)
+            recorded = True
+            return response
+        ENGINE_BREAKER.record(False)
+        recorded = True
+        if futures or isinstance(last_error, requests.Timeout):
+            raise EngineError(504, f"Deadline exceeded waiting for {path}")
+        if isinstance(last_error, EngineError):
+            raise last_error
+        raise EngineError(502, f"{path} failed: {last_error}")
+    finally:
+        if not recorded:
+            ENGINE_BREAKER.release_probe()
+
+def build_audio_query(spk_id, target_text, params, deadline):
+    res = engine_post("/audio_query", deadline, params={"text": target_text, "speaker": spk_id})
+    if res.status_code != 200:
+        raise EngineError(502, f"audio_query failed: {res.status_code} {res.text[:200]}")
+    try:
+        q = res.json()
+    except ValueError:
+        raise EngineError(502, f"audio_query returned invalid JSON: {res.text[:200]}")
+    if not isinstance(q, dict) or not isinstance(q.get("accent_phrases"), list):
+        raise EngineError(502, "audio_query returned no accent_phrases")
+    q["speedScale"] = params.speedScale
+    q["pitchScale"] = params.pitchScale
+    q["intonationScale"] = params.intonationScale
+    q["volumeScale"] = params.volumeScale
+    q["prePhonemeLength"] = params.prePhonemeLength
+    q["postPhonemeLength"] = params.postPhonemeLength
+    # Always synthesize at the engine's native rate in mono; the requested
+    # rate/channels are produced locally by convert_wav_format.
+    q["outputStereo"] = False
+    if hasattr(params, 'kana') and params.kana:
+        q["kana"] = params.kana
+    if hasattr(params, 'pauseLength') and params.pauseLength is not None:
+        q["pauseLength"] = params.pauseLength
+    if hasattr(params, 'pauseLengthScale') and params.pauseLengthScale is not None:
+        q["pauseLengthScale"] = params.pauseLengthScale
+    return q
+
+def check_engine_wav(data, what):
+    # A 200 from the engine is only used (cached, billed) if it is a WAV.
+    try:
+        with wave.open(io.BytesIO(data), "rb") as w:
+            w.getparams()
+    except (wave.Error, EOFError) as e:
+        raise EngineError(502, f"{what} returned an invalid WAV: {e}")
+    return data
+
+def synthesize_one(spk_id, query, deadline):
+    synth_res = engine_post("/synthesis", deadline, params={"speaker": spk_id}, json=query)
+    if synth_res.status_code != 200:
+        raise EngineError(502, f"Synthesis failed: {synth_res.status_code} {synth_res.text[:200]}")
+    return check_engine_wav(synth_res.content, "Synthesis")
+
+def synthesize_batch(spk_id, queries, deadline):
+    # One /multi_synthesis round-trip for all queries of a style; the engine
+    # answers with a zip of 001.wav, 002.wav, ... in query order.
+    if len(queries) > 1 and ENGINE_FEATURES["multi_synthesis"]:
+        res = engine_post("/multi_synthesis", deadline, params={"speaker": spk_id}, json=queries)
+        if res.status_code == 200:
+            try:
+                with zipfile.ZipFile(io.BytesIO(res.content)) as zf:
+                    names = sorted(n for n in zf.namelist() if n.lower().endswith(".wav"))
+                    if len(names) == len(queries):
+                        return [check_engine_wav(zf.read(n), "Multi synthesis") for n in names]
+                logging.error(f"Multi synthesis returned {len(names)} waves for {len(queries)} queries")
+            except zipfile.BadZipFile as e:
+                logging.error(f"Multi synthesis returned invalid zip: {e}")
+        elif res.status_code in (404, 405, 501):
+            ENGINE_FEATURES["multi_synthesis"] = False
+            logging.warning("Engine has no /multi_synthesis, falling back to per-segment synthesis")
+        else:
+            logging.error(f"Multi synthesis failed: {res.status_code} {res.text[:200]}")
+    return [synthesize_one(spk_id, q, deadline) for q in queries]
+
+def connect_waves_on_engine(waves, deadline):
+    if not ENGINE_FEATURES["connect_waves"]:
+        return None
+    try:
+        res = engine_post("/connect_waves", deadline, json=[base64.b64encode(w).decode("ascii") for w in waves])
+    except EngineError as e:
+        logging.error(f"connect_waves failed: {e}")
+        return None
+    if res.status_code == 200:
+        try:
+            return check_engine_wav(res.content, "connect_waves")
+        except EngineError as e:
+            logging.error(f"{e.detail}, concatenating locally")
+            return None
+    if res.status_code in (404, 405, 501):
+        ENGINE_FEATURES["connect_waves"] = False
+        logging.warning("Engine has no /connect_waves, concatenating locally")
+    else:
+        logging.error(f"connect_waves failed: {res.status_code} {res.text[:200]}")
+    return None
+
+def render_segment_waves(segments, params, deadline, queries=None):
+    # Native-rate mono wave per non-empty segment, served from CACHE where
+    # possible; misses are synthesized and stored together with their
+    # AudioQuery. When `queries` is a list it receives one
+    # {"speaker", "text", "query"} per returned wave.
+    use_pseudo = getattr(params, "mode", "pseudo_jp") == "pseudo_jp"
+    segments = [(spk_id, text) for spk_id, text in segments if text]
+    texts = [text for _, text in segments]
+    with timed("convert"):
+        targets = convert_texts(texts) if use_pseudo else texts
+    waves = []
+    pending = {}
+    for (spk_id, text), target_text in zip(segments, targets):
+        key = segment_cache_key(spk_id, target_text, params)
+        wav = CACHE.get(key)
+        query = None
+        if wav is not None and queries is not None:
+            cached_query = CACHE.get("query:" + key)
+            if cached_query is None:
+                wav = None # timing requested but the query was evicted
+            else:
+                query = json.loads(cached_query)
+        if wav is None:
+            with timed("audio_query"):
+                query = build_audio_query(spk_id, target_text, params, deadline)
+            pending.setdefault(spk_id, []).append((len(waves), key, query))
+        if queries is not None:
+            queries.append({"speaker": spk_id, "text": text, "query": query})
+        waves.append(wav)
+
+    # Batch every uncached query of the same style into one engine call,
+    # then put the waves back into segment order.
+    for spk_id, items in pending.items():
+        with timed("synthesis"):
+            batch = synthesize_batch(spk_id, [q for _, _, q in items], deadline)
+        for (idx, key, query), wav in zip(items, batch):
+            if wav:
+                CACHE.set(key, wav)
+                CACHE.set("query:" + key, json.dumps(query, ensure_ascii=False).encode("utf-8"))
+            waves[idx] = wav
+    return waves
+
+def generate_combined_audio(segments, params, deadline: Optional[float] = None, segment_info=None):
+    # Engine failures, unusable engine replies included, raise EngineError
+    # instead of silently dropping the segment or returning an empty WAV;
+    # callers turn it into an HTTP error and skip billing.
+    # `segment_info`, when a list, receives speaker/text/query/duration for
+    # every segment in output order (used for mora timing).
+    deadline = deadline or new_deadline()
+    try:
+        for spk_id, text in segments:
+            if text: STYLE_HITS[spk_id] += 1
+        waves = render_segment_waves(segments, params, deadline, segment_info)
+        if segment_info is not None:
+            for info, wav in zip(segment_info, waves):
+                info["duration"] = wav_duration(wav)
+    except EngineError:
+        raise
+    except Exception as e:
+        logging.error(f"Audio gen error: {e}")
+        raise EngineError(502, f"Audio generation failed: {e}")
+    return combine_waves(waves, params, deadline)
+
+def combine_waves(waves, params, deadline):
+    # Native-rate segment waves -> one WAV in the requested format, with BGM.
     audio_files = []
     temp_files = []
     try:
-        for spk_id, text in segments:
-            if not text: continue
-            use_pseudo = getattr(params, "mode", "pseudo_jp") == "pseudo_jp"
-            target_text = converter.convert(text) if use_pseudo else text
-            q = requests.post(f"{VOICEVOX_URL}/audio_query", params={"text": target_text, "speaker": spk_id}, verify=False).json()
-            q["speedScale"] = params.speedScale
-            q["pitchScale"] = params.pitchScale
-            q["intonationScale"] = params.intonationScale
-            q["volumeScale"] = params.volumeScale
-            q["prePhonemeLength"] = params.prePhonemeLength
-            q["postPhonemeLength"] = params.postPhonemeLength
-            if hasattr(params, 'outputSamplingRate') and params.outputSamplingRate:
-                q["outputSamplingRate"] = params.outputSamplingRate
-            if hasattr(params, 'outputStereo') and params.outputStereo is not None:
-                q["outputStereo"] = params.outputStereo
-            if hasattr(params, 'kana') and params.kana:
-                q["kana"] = params.kana
-            if hasattr(params, 'pauseLength') and params.pauseLength is not None:
-                q["pauseLength"] = params.pauseLength
-            if hasattr(params, 'pauseLengthScale') and params.pauseLengthScale is not None:
-                q["pauseLengthScale"] = params.pauseLengthScale
-
-            synth_res = requests.post(f"{VOICEVOX_URL}/synthesis", params={"speaker": spk_id}, json=q, verify=False)
-            if synth_res.status_code != 200:
-                logging.error(f"Synthesis failed: {synth_res.status_code} {synth_res.text[:200]}")
-                continue
-            wav = synth_res.content
-            tf = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-            tf.write(wav)
-            tf.close()
-            temp_files.append(tf.name)
-            audio_files.append(tf.name)
-        if not audio_files: return b""
-        if len(audio_files) == 1:
-            with open(audio_files[0], "rb") as f:
-                base_audio = f.read()
+        out_rate = getattr(params, "outputSamplingRate", None)
+        out_stereo = bool(getattr(params, "outputStereo", False))
+        with timed("resample"):
+            waves = [convert_wav_format(w, out_rate, out_stereo) for w in waves if w]
+
+        if not waves: return b""
+        if len(waves) == 1:
+            base_audio = waves[0]
             if getattr(params, "bgmEnabled", False):
                 return mix_with_bgm(base_audio, getattr(params, "bgmVolume", 0.5), getattr(params, "bgmFilePath", None))
             return base_audio
-        list_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False, mode="w")
-        for f in audio_files: list_file.write(f"file '{f}'\n")
-        list_file.close()
-        temp_files.append(list_file.name)
-        out_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
-        temp_files.append(out_file)
-        try:
-            subprocess.run(
-                ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file.name, "-c", "copy", out_file],
-                check=True,
-                stderr=subprocess.PIPE
-            )
-            with open(out_file, "rb") as f:
-                merged_audio = f.read()
-        except FileNotFoundError:
-            merged_audio = concat_wavs(audio_files)
+        with timed("concat"):
+            merged_audio = connect_waves_on_engine(waves, deadline)
+            if merged_audio is None:
+                for wav in waves:
+                    tf = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+                    tf.write(wav)
+                    tf.close()
+                    temp_files.append(tf.name)
+                    audio_files.append(tf.name)
+                list_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False, mode="w")
+                for f in audio_files: list_file.write(f"file '{f}'\n")
+                list_file.close()
+                temp_files.append(list_file.name)
+                out_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
+                temp_files.append(out_file)
+                try:
+                    subprocess.run(
+                        ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file.name, "-c", "copy", out_file],
+                        check=True,
+                        stderr=subprocess.PIPE
+                    )
+                    with open(out_file, "rb") as f:
+                        merged_audio = f.read()
+                except FileNotFoundError:
+                    merged_audio = concat_wavs(audio_files)
         if getattr(params, "bgmEnabled", False):
             return mix_with_bgm(merged_audio, getattr(params, "bgmVolume", 0.5), getattr(params, "bgmFilePath", None))
         return merged_audio
+    except EngineError:
+        raise
     except Exception as e:
         logging.error(f"Audio gen error: {e}")
-        return b""
+        raise EngineError(502, f"Audio generation failed: {e}")
     finally:
         for f in temp_files:
             if os.path.exists(f): os.unlink(f)
@@ -539,7 +1749,7 @@ def generate_combined_audio(segments, params):
 @app.get("/voices")
 def get_voices():
     try:
-        r = requests.get(f"{VOICEVOX_URL}/speakers", verify=False).json()
+        r = fetch_speakers()
     except: return []
     grouped = {}
     for char in r:
@@ -556,22 +1766,801 @@ def get_voices():
 def get_character_info(uuid: str):
     return {"portrait_url": f"/static/{uuid}_portrait.png", "sample_urls": [f"/static/{uuid}_sample_{i}.wav" for i in range(1, 4)]}
 
-@app.post("/tts")
-def tts(req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    x_api_key = normalize_api_key(x_api_key)
-    user = db.query(User).filter(User.api_key == x_api_key).first()
+def charge_for_text(db: Session, api_key: str, text: str):
+    # Users pay per character, legacy keys one credit per call. The caller
+    # commits once the audio has been generated.
+    user = db.query(User).filter(User.api_key == api_key).first()
     if user:
-        cost = len(req.text)
+        cost = len(text)
         if user.balance < cost: raise HTTPException(status_code=402, detail="Insufficient balance")
         user.balance -= cost
     else:
-        record = db.query(APIKeyRecord).filter(APIKeyRecord.key == x_api_key).first()
+        record = db.query(APIKeyRecord).filter(APIKeyRecord.key == api_key).first()
         if not record or record.credits <= 0: raise HTTPException(status_code=401, detail="Invalid key or no credits")
         record.credits -= 1
-    segments = parse_segments(req.text, req.speaker)
-    audio = generate_combined_audio(segments, req)
-    db.commit()
-    return Response(content=audio, media_type="audio/wav")
+
+def require_valid_key(db: Session, api_key: str):
+    # For endpoints that do not charge themselves (billing happens later).
+    if not db.query(User).filter(User.api_key == api_key).first() and not db.query(APIKeyRecord).filter(APIKeyRecord.key == api_key).first():
+        raise HTTPException(status_code=401, detail="Invalid key")
+
+# --- 用量记录 ---
+# The request path only appends a dict to USAGE_QUEUE; a background thread
+# batch-inserts events and periodically folds them into hourly rollups.
+USAGE_QUEUE = deque(maxlen=100_000)
+BACKGROUND_STOP = threading.Event()
+PROSODY_FIELDS = (
+    "speedScale", "pitchScale", "intonationScale", "volumeScale",
+    "prePhonemeLength", "postPhonemeLength", "pauseLength", "pauseLengthScale",
+)
+
+def prosody_params(params):
+    return {name: getattr(params, name, None) for name in PROSODY_FIELDS}
+
+def wav_duration(audio) -> float:
+    # `audio` is WAV bytes or a path to a WAV file.
+    try:
+        with wave.open(audio if isinstance(audio, str) else io.BytesIO(audio), "rb") as w:
+            return w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError, OSError):
+        return 0.0
+
+@contextmanager
+def track_usage(endpoint, api_key, text, params, started=None):
+    # Yields the event so the caller can fill in audio_seconds. `started`
+    # (a time.perf_counter() value) backdates the latency for work that
+    # began before the block.
+    event = {
+        "created_at": datetime.utcnow(),
+        "api_key": api_key,
+        "endpoint": endpoint,
+        "speaker": getattr(params, "speaker", None),
+        "mode": getattr(params, "mode", None),
+        "chars": len(text),
+        "audio_seconds": 0.0,
+        "text_hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        "text": text if len(text) <= USAGE_PHRASE_MAX_CHARS else None,
+        "params": json.dumps(prosody_params(params), sort_keys=True),
+    }
+    started = started or time.perf_counter()
+    ACTIVE_REQUESTS.add(1)
+    try:
+        yield event
+        event["status"] = 200
+    except Exception as e:
+        event["status"] = getattr(e, "status_code", 500)
+        raise
+    finally:
+        ACTIVE_REQUESTS.add(-1)
+        event["latency_ms"] = int((time.perf_counter() - started) * 1000)
+        USAGE_QUEUE.append(event)
+
+def flush_usage_events():
+    batch = []
+    while USAGE_QUEUE and len(batch) < 5000:
+        batch.append(USAGE_QUEUE.popleft())
+    if not batch:
+        return 0
+    db = SessionLocal()
+    try:
+        db.bulk_insert_mappings(UsageEvent, batch)
+        db.commit()
+    except Exception as e:
+        logging.error(f"Failed to write {len(batch)} usage events: {e}")
+    finally:
+        db.close()
+    return len(batch)
+
+def rollup_usage():
+    # Safe to run concurrently (usage thread, /admin/usage, several workers):
+    # each pass claims its rows with a single UPDATE tagging them with its
+    # run id, and only aggregates the rows it tagged. Totals are added with
+    # UPDATE ... SET x = x + n so concurrent passes never overwrite each other.
+    run_id = secrets.randbelow(2**31 - 2) + 2 # 1 marks rows rolled up before run ids
+    db = SessionLocal()
+    try:
+        while True:
+            ids = [i for (i,) in db.query(UsageEvent.id).filter(UsageEvent.rolled_up == 0).order_by(UsageEvent.id).limit(5000)]
+            if not ids:
+                break
+            in_batch = (UsageEvent.id >= ids[0], UsageEvent.id <= ids[-1])
+            claimed = db.query(UsageEvent).filter(*in_batch, UsageEvent.rolled_up == 0).update(
+                {UsageEvent.rolled_up: run_id}, synchronize_session=False)
+            if not claimed:
+                db.commit()
+                continue
+            events = db.query(UsageEvent).filter(*in_batch, UsageEvent.rolled_up == run_id).all()
+            buckets = {}
+            for ev in events:
+                key = (ev.created_at.replace(minute=0, second=0, microsecond=0), ev.api_key or "", ev.speaker if ev.speaker is not None else -1)
+                b = buckets.setdefault(key, [0, 0, 0, 0.0, 0])
+                b[0] += 1
+                b[1] += 1 if (ev.status or 500) >= 400 else 0
+                b[2] += ev.chars or 0
+                b[3] += ev.audio_seconds or 0.0
+                b[4] += ev.latency_ms or 0
+            for (hour, api_key, speaker), (n, errors, chars, seconds, latency) in buckets.items():
+                updated = db.query(UsageRollup).filter(
+                    UsageRollup.hour == hour, UsageRollup.api_key == api_key, UsageRollup.speaker == speaker,
+                ).update({
+                    UsageRollup.requests: UsageRollup.requests + n,
+                    UsageRollup.errors: UsageRollup.errors + errors,
+                    UsageRollup.chars: UsageRollup.chars + chars,
+                    UsageRollup.audio_seconds: UsageRollup.audio_seconds + seconds,
+                    UsageRollup.latency_ms: UsageRollup.latency_ms + latency,
+                }, synchronize_session=False)
+                if not updated:
+                    db.add(UsageRollup(hour=hour, api_key=api_key, speaker=speaker, requests=n, errors=errors, chars=chars, audio_seconds=seconds, latency_ms=latency))
+            # Claim and totals commit together: if another pass inserted the
+            # same rollup row first, this batch rolls back and is retried later.
+            db.commit()
+        cutoff = datetime.utcnow() - timedelta(days=USAGE_RETENTION_DAYS)
+        db.query(UsageEvent).filter(UsageEvent.created_at < cutoff, UsageEvent.rolled_up != 0).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Usage rollup failed: {e}")
+    finally:
+        db.close()
+
+def usage_worker():
+    next_rollup = time.monotonic() + USAGE_ROLLUP_INTERVAL
+    while not BACKGROUND_STOP.wait(USAGE_FLUSH_INTERVAL):
+        while flush_usage_events():
+            pass
+        if time.monotonic() >= next_rollup:
+            rollup_usage()
+            next_rollup = time.monotonic() + USAGE_ROLLUP_INTERVAL
+    flush_usage_events()
+
+@app.on_event("startup")
+def start_usage_worker():
+    BACKGROUND_STOP.clear()
+    threading.Thread(target=usage_worker, daemon=True, name="usage").start()
+
+@app.on_event("shutdown")
+def stop_usage_worker():
+    BACKGROUND_STOP.set()
+    while flush_usage_events():
+        pass
+
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+def admin_usage(group_by: str = "key", hours: int = 24, limit: int = 100, db: Session = Depends(get_db)):
+    # group_by: key | speaker | hour (from rollups) or phrase (hot short
+    # phrases from raw events, i.e. candidates for precomputation).
+    while flush_usage_events():
+        pass
+    since = datetime.utcnow() - timedelta(hours=hours)
+    if group_by == "phrase":
+        rows = (
+            db.query(UsageEvent.text_hash, func.min(UsageEvent.text), UsageEvent.speaker, func.count(UsageEvent.id), func.sum(UsageEvent.audio_seconds))
+            .filter(UsageEvent.created_at >= since, UsageEvent.text.isnot(None))
+            .group_by(UsageEvent.text_hash, UsageEvent.speaker)
+            .order_by(func.count(UsageEvent.id).desc())
+            .limit(limit)
+            .all()
+        )
+        return [{"text": text, "speaker": speaker, "requests": n, "audio_seconds": round(seconds or 0, 2)} for _, text, speaker, n, seconds in rows]
+    columns = {"key": UsageRollup.api_key, "speaker": UsageRollup.speaker, "hour": UsageRollup.hour}
+    if group_by not in columns:
+        raise HTTPException(status_code=400, detail="group_by must be key, speaker, hour or phrase")
+    rollup_usage()
+    column = columns[group_by]
+    rows = (
+        db.query(column, func.sum(UsageRollup.requests), func.sum(UsageRollup.errors), func.sum(UsageRollup.chars),
+                 func.sum(UsageRollup.audio_seconds), func.sum(UsageRollup.latency_ms))
+        .filter(UsageRollup.hour >= since.replace(minute=0, second=0, microsecond=0))
+        .group_by(column)
+        .order_by(column if group_by == "hour" else func.sum(UsageRollup.requests).desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {
+            group_by: value.isoformat() if isinstance(value, datetime) else value,
+            "requests": n, "errors": errors, "chars": chars,
+            "audio_seconds": round(seconds or 0, 2),
+            "avg_latency_ms": round(latency / n) if n else 0,
+        }
+        for value, n, errors, chars, seconds, latency in rows
+    ]
+
+# --- 预热 ---
+# After startup and whenever the engine comes back from an outage, load the
+# most used styles with /initialize_speaker and pre-synthesize the hottest
+# phrases into CACHE. Runs on its own thread (separate from the health
+# checks, so a long prewarm never delays outage detection) and yields to
+# live traffic through low-priority engine slots.
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+ACTIVE_REQUESTS = Gauge()
+STYLE_HITS = Counter()
+PREWARM_TRIGGER = threading.Event()
+PREWARM_STATUS = {
+    "engine": "unknown", "state": "idle", "runs": 0,
+    "styles_total": 0, "styles_done": 0, "phrases_total": 0, "phrases_done": 0,
+    "errors": 0, "started_at": None, "finished_at": None,
+    "styles_ready": False, # sticky once the first styles pass has finished
+}
+
+def popular_styles(limit):
+    counts = Counter(STYLE_HITS)
+    db = SessionLocal()
+    try:
+        since = datetime.utcnow() - timedelta(days=PREWARM_LOOKBACK_DAYS)
+        rows = (
+            db.query(UsageRollup.speaker, func.sum(UsageRollup.requests))
+            .filter(UsageRollup.hour >= since, UsageRollup.speaker >= 0)
+            .group_by(UsageRollup.speaker)
+            .all()
+        )
+    finally:
+        db.close()
+    for speaker, n in rows:
+        counts[speaker] += n or 0
+    return [speaker for speaker, _ in counts.most_common(limit)]
+
+def popular_phrases(limit):
+    db = SessionLocal()
+    try:
+        since = datetime.utcnow() - timedelta(days=PREWARM_LOOKBACK_DAYS)
+        return (
+            db.query(func.min(UsageEvent.text), UsageEvent.speaker, UsageEvent.mode, UsageEvent.params)
+            .filter(UsageEvent.created_at >= since, UsageEvent.text.isnot(None), UsageEvent.status == 200)
+            .group_by(UsageEvent.text_hash, UsageEvent.speaker, UsageEvent.mode, UsageEvent.params)
+            .order_by(func.count(UsageEvent.id).desc())
+            .limit(limit)
+            .all()
+        )
+    finally:
+        db.close()
+
+def run_prewarm():
+    status = PREWARM_STATUS
+    status.update(state="running", runs=status["runs"] + 1, styles_done=0, phrases_done=0, errors=0,
+                  started_at=datetime.utcnow().isoformat(), finished_at=None)
+    styles = popular_styles(PREWARM_STYLES) if PREWARM_STYLES > 0 else []
+    phrases = popular_phrases(PREWARM_PHRASES) if PREWARM_PHRASES > 0 else []
+    status.update(styles_total=len(styles), phrases_total=len(phrases))
+    for style_id in styles:
+        try:
+            res = engine_post("/initialize_speaker", new_deadline(120), hedge=False,
+                              params={"speaker": style_id, "skip_reinit": "true"})
+            if res.status_code >= 400:
+                raise EngineError(502, f"initialize_speaker {style_id}: {res.status_code}")
+        except EngineError as e:
+            status["errors"] += 1
+            logging.error(f"Prewarm failed: {e.detail}")
+        status["styles_done"] += 1
+    status["styles_ready"] = True
+    for text, speaker, mode, params_json in phrases:
+        try:
+            params = TTSRequest(text=text, speaker=speaker, mode=mode or "pseudo_jp", **json.loads(params_json or "{}"))
+            render_segment_waves(parse_segments(text, speaker), params, new_deadline())
+        except Exception as e:
+            status["errors"] += 1
+            logging.error(f"Prewarm of phrase failed: {getattr(e, 'detail', e)}")
+        status["phrases_done"] += 1
+    status.update(state="done", finished_at=datetime.utcnow().isoformat())
+
+def engine_healthy():
+    try:
+        return requests.get(f"{VOICEVOX_URL}/version", timeout=5, verify=False).status_code == 200
+    except requests.RequestException:
+        return False
+
+def health_worker():
+    # Any transition to "up" (including the first check) triggers a prewarm.
+    while not BACKGROUND_STOP.is_set():
+        healthy = engine_healthy()
+        was = PREWARM_STATUS["engine"]
+        PREWARM_STATUS["engine"] = "up" if healthy else "down"
+        if healthy and was != "up" and PREWARM_ENABLED:
+            if was == "down":
+                logging.warning("Engine recovered, prewarming")
+            PREWARM_TRIGGER.set()
+        BACKGROUND_STOP.wait(HEALTH_INTERVAL)
+
+def prewarm_worker():
+    # Triggers that arrive while a run is in progress collapse into one rerun.
+    while not BACKGROUND_STOP.is_set():
+        if not PREWARM_TRIGGER.wait(1.0):
+            continue
+        PREWARM_TRIGGER.clear()
+        try:
+            with engine_priority("low"):
+                run_prewarm()
+        except Exception as e:
+            PREWARM_STATUS["state"] = "failed"
+            logging.error(f"Prewarm failed: {e}")
+
+@app.on_event("startup")
+def start_health_worker():
+    threading.Thread(target=health_worker, daemon=True, name="health").start()
+    threading.Thread(target=prewarm_worker, daemon=True, name="prewarm").start()
+
+@app.get("/ready")
+def ready():
+    # Ready once the engine answers and the popular styles have been loaded
+    # once; phrase pre-synthesis and later recovery prewarms keep going in
+    # the background without taking the instance out of rotation.
+    status = dict(PREWARM_STATUS)
+    status["ready"] = status["engine"] == "up" and (not PREWARM_ENABLED or status["styles_ready"])
+    status["active_requests"] = ACTIVE_REQUESTS.value
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text format.
+    limiter = ENGINE_LIMITER.snapshot()
+    lines = [
+        f"voicevox_engine_concurrency_limit {limiter['limit']}",
+        f"voicevox_engine_in_flight {limiter['in_flight']}",
+        f'voicevox_engine_queue_depth{{priority="high"}} {limiter["queued_high"]}',
+        f'voicevox_engine_queue_depth{{priority="low"}} {limiter["queued_low"]}',
+        f"voicevox_engine_calls_total {limiter['acquired']}",
+        f"voicevox_engine_queue_timeouts_total {limiter['rejected']}",
+        f"voicevox_engine_drops_total {limiter['drops']}",
+        f"voicevox_engine_hedges_total {HEDGE_STATS['hedges']}",
+        f"voicevox_engine_circuit_open {int(ENGINE_BREAKER.state() != 'closed')}",
+        f"voicevox_active_requests {ACTIVE_REQUESTS.value}",
+    ]
+    for path, tracker in sorted(ENGINE_LATENCY.items()):
+        p95 = tracker.percentile(0.95)
+        if p95 is not None:
+            lines.append(f'voicevox_engine_latency_p95_seconds{{path="{path}"}} {p95:.4f}')
+    return "\n".join(lines) + "\n"
+
+# --- 口型同步：音素时间轴与视素 ---
+# Timings come from the AudioQuery each segment was synthesized from, so no
+# extra engine call is needed. Lengths are scaled by speedScale and rounded
+# to the engine's 24000/256 Hz frame grid like the engine itself does.
+ENGINE_FRAME_RATE = 24000 / 256
+VISEME_BY_VOWEL = {"a": "a", "i": "i", "u": "u", "e": "e", "o": "o", "N": "n", "cl": "sil", "pau": "sil"}
+CLOSED_CONSONANTS = {"m", "my", "b", "by", "p", "py"}
+LABIODENTAL_CONSONANTS = {"f", "v"}
+
+def phoneme_seconds(length, speed):
+    return round((length or 0.0) / speed * ENGINE_FRAME_RATE) / ENGINE_FRAME_RATE
+
+def query_moras(query):
+    # [{"text", "phonemes": [(phoneme, start, end)]}] relative to the start
+    # of the segment; leading/trailing silence is a mora with empty text.
+    speed = query.get("speedScale") or 1.0
+    pause_length = query.get("pauseLength")
+    pause_scale = query.get("pauseLengthScale") or 1.0
+    t = phoneme_seconds(query.get("prePhonemeLength"), speed)
+    moras = [{"text": "", "phonemes": [("pau", 0.0, t)]}]
+    for phrase in query.get("accent_phrases") or []:
+        items = list(phrase.get("moras") or [])
+        pause = phrase.get("pause_mora")
+        if pause:
+            pause = dict(pause)
+            if pause_length is not None:
+                pause["vowel_length"] = pause_length
+            pause["vowel_length"] = (pause.get("vowel_length") or 0.0) * pause_scale
+            items.append(pause)
+        for mora in items:
+            phonemes = []
+            if mora.get("consonant"):
+                end = t + phoneme_seconds(mora.get("consonant_length"), speed)
+                phonemes.append((mora["consonant"], t, end))
+                t = end
+            end = t + phoneme_seconds(mora.get("vowel_length"), speed)
+            phonemes.append((mora.get("vowel") or "pau", t, end))
+            t = end
+            moras.append({"text": mora.get("text", ""), "phonemes": phonemes})
+    moras.append({"text": "", "phonemes": [("pau", t, t + phoneme_seconds(query.get("postPhonemeLength"), speed))]})
+    return moras
+
+def mora_visemes(phonemes):
+    # Bilabials and f/v get their own mouth shape; every other consonant is
+    # drawn with the shape of the vowel it leads into. Unvoiced vowels are
+    # upper-case in VOICEVOX (A, I, U, E, O).
+    vowel = phonemes[-1][0]
+    vowel_viseme = VISEME_BY_VOWEL.get(vowel if vowel in VISEME_BY_VOWEL else vowel.lower(), "sil")
+    out = []
+    for phoneme, start, end in phonemes:
+        if phoneme in CLOSED_CONSONANTS:
+            out.append(("closed", start, end))
+        elif phoneme in LABIODENTAL_CONSONANTS:
+            out.append(("fv", start, end))
+        else:
+            out.append((vowel_viseme, start, end))
+    return out
+
+def build_timing(segment_info):
+    segments, moras, visemes = [], [], []
+    offset = 0.0
+    for idx, info in enumerate(segment_info):
+        segments.append({"index": idx, "speaker": info["speaker"], "text": info["text"],
+                         "start": round(offset, 4), "end": round(offset + info["duration"], 4)})
+        for mora in query_moras(info["query"]):
+            # Clamp to the real segment length so segments never overlap.
+            phonemes = [
+                (ph, offset + start, offset + min(end, info["duration"]))
+                for ph, start, end in mora["phonemes"] if min(end, info["duration"]) > start
+            ]
+            if not phonemes:
+                continue
+            if mora["text"]:
+                moras.append({
+                    "segment": idx, "text": mora["text"],
+                    "start": round(phonemes[0][1], 4), "end": round(phonemes[-1][2], 4),
+                    "phonemes": [{"phoneme": ph, "start": round(start, 4), "end": round(end, 4)} for ph, start, end in phonemes],
+                })
+            for viseme, start, end in mora_visemes(phonemes):
+                if visemes and visemes[-1]["viseme"] == viseme and abs(visemes[-1]["end"] - start) < 1e-3:
+                    visemes[-1]["end"] = round(end, 4)
+                else:
+                    visemes.append({"viseme": viseme, "start": round(start, 4), "end": round(end, 4)})
+        offset += info["duration"]
+    return {"segments": segments, "moras": moras, "visemes": visemes}
+
+# --- 结果存储 ---
+# Long renders are written straight to RESULT_DIR/<id>.wav a few segments at a
+# time instead of being assembled in memory, and the client is redirected
+# (303) to /results/<id>, which supports Range requests and conditional GETs.
+# Result ids are unguessable and results expire RESULT_TTL seconds after
+# they were rendered.
+class ResultStore:
+    ID_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, root, ttl):
+        self.root = root
+        self.ttl = ttl
+        self.next_sweep = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, result_id):
+        return os.path.join(self.root, f"{result_id}.wav")
+
+    @contextmanager
+    def new_result(self):
+        # Yields (result_id, tmp_path); the file is published under
+        # result_id only if the block completes.
+        result_id = secrets.token_urlsafe(18)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-", suffix=".wav")
+        os.close(fd)
+        try:
+            yield result_id, tmp_path
+            os.replace(tmp_path, self._path(result_id))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        if time.monotonic() >= self.next_sweep:
+            self.next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+            self.sweep()
+
+    def path(self, result_id):
+        if not self.ID_RE.match(result_id):
+            return None
+        path = self._path(result_id)
+        try:
+            if os.stat(path).st_mtime + self.ttl < time.time():
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+
+    def sweep(self):
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                # Half-written files are left alone for an hour.
+                max_age = 3600 if entry.name.startswith(".tmp-") else self.ttl
+                if entry.stat().st_mtime + max_age < now:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+RESULTS = ResultStore(RESULT_DIR, RESULT_TTL)
+
+def write_combined_audio(segments, params, path, deadline: Optional[float] = None):
+    # Disk-backed counterpart of generate_combined_audio: segments are
+    # rendered RESULT_BATCH_SEGMENTS at a time and appended to `path`, so
+    # memory use does not grow with the length of the output.
+    deadline = deadline or new_deadline()
+    # Untagged text is a single segment; cut it into sentences so no batch
+    # holds more than a few sentences of audio.
+    segments = sentence_segments(segments)
+
+    def waves():
+        for start in range(0, len(segments), RESULT_BATCH_SEGMENTS):
+            batch = segments[start:start + RESULT_BATCH_SEGMENTS]
+            for spk_id, _ in batch:
+                STYLE_HITS[spk_id] += 1
+            yield from render_segment_waves(batch, params, deadline)
+
+    write_waves(waves(), params, path)
+
+def write_waves(waves, params, path):
+    # Appends native-rate segment waves (any iterable) to the WAV at `path`
+    # in the requested output format, then mixes in BGM.
+    out_rate = getattr(params, "outputSamplingRate", None)
+    out_channels = 2 if getattr(params, "outputStereo", False) else 1
+    with wave.open(path, "wb") as out_wav:
+        out_wav.setnchannels(out_channels)
+        out_wav.setsampwidth(2)
+        out_wav.setframerate(out_rate or 24000)
+        for wav in waves:
+            if not wav:
+                continue
+            if not out_rate:
+                # Keep the first segment's native rate for the whole file.
+                with wave.open(io.BytesIO(wav), "rb") as w:
+                    out_rate = w.getframerate()
+                out_wav.setframerate(out_rate)
+            with timed("resample"):
+                wav = convert_wav_format(wav, out_rate, out_channels == 2)
+            with wave.open(io.BytesIO(wav), "rb") as w:
+                out_wav.writeframes(w.readframes(w.getnframes()))
+    bgm_src = getattr(params, "bgmFilePath", None) or BGM_FILE
+    if getattr(params, "bgmEnabled", False) and bgm_src and os.path.exists(bgm_src):
+        mixed_path = path + ".bgm.wav"
+        with timed("bgm"):
+            try:
+                run_bgm_mix(path, mixed_path, getattr(params, "bgmVolume", 0.5), bgm_src)
+                os.replace(mixed_path, path)
+            except Exception as e:
+                logging.error(f"BGM mix failed: {e}")
+            finally:
+                if os.path.exists(mixed_path):
+                    os.unlink(mixed_path)
+
+def sentence_segments(segments):
+    out = []
+    for spk_id, text in segments:
+        sentences, rest = split_sentences(text or "")
+        out.extend((spk_id, sentence) for sentence in sentences + ([rest.strip()] if rest.strip() else []))
+    return out
+
+def wants_result(params):
+    # Opt-in: the default response stays a plain audio/wav body.
+    return bool(getattr(params, "result", False))
+
+def result_response(result_id, duration, timings):
+    url = f"/results/{result_id}"
+    return JSONResponse(
+        status_code=303,
+        content={
+            "result_id": result_id,
+            "url": url,
+            "duration": round(duration, 4),
+            "bytes": os.path.getsize(RESULTS.path(result_id)),
+            "expires_in": RESULT_TTL,
+        },
+        headers={"Location": url, "Server-Timing": server_timing_header(timings)},
+    )
+
+def parse_byte_range(header, size):
+    # Single "bytes=" range -> (start, end) inclusive; None if unsatisfiable.
+    # Raises ValueError for anything we don't serve partially (multiple
+    # ranges, other units, malformed), which callers answer with a full 200.
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        raise ValueError(header)
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        suffix = int(last)
+        if suffix <= 0:
+            return None
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def iter_file(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def not_modified(request: Request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.api_route("/results/{result_id}", methods=["GET", "HEAD"])
+def get_result(result_id: str, request: Request):
+    path = RESULTS.path(result_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    st = os.stat(path)
+    etag = f'"{result_id}-{int(st.st_mtime)}-{st.st_size}"'
+    last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"private, max-age={max(0, int(st.st_mtime + RESULT_TTL - time.time()))}",
+    }
+    if not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=headers)
+    status_code, start, end = 200, 0, st.st_size - 1
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range in (etag, last_modified)):
+        try:
+            byte_range = parse_byte_range(range_header, st.st_size)
+        except ValueError:
+            byte_range = (start, end)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+        if byte_range != (0, st.st_size - 1):
+            status_code, (start, end) = 206, byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type="audio/wav")
+    return StreamingResponse(iter_file(path, start, end), status_code=status_code, headers=headers, media_type="audio/wav")
+
+@app.post("/tts")
+def tts(req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    timings = start_request_timing()
+    api_key = normalize_api_key(x_api_key)
+    with track_usage("/tts", api_key, req.text, req) as usage:
+        with timed("auth"):
+            charge_for_text(db, api_key, req.text)
+        segments = parse_segments(req.text, req.speaker)
+        if wants_result(req):
+            with RESULTS.new_result() as (result_id, path):
+                write_combined_audio(segments, req, path, new_deadline(req.timeout))
+            audio = RESULTS.path(result_id)
+        else:
+            audio = generate_combined_audio(segments, req, new_deadline(req.timeout))
+        with timed("auth"):
+            db.commit()
+        usage["audio_seconds"] = wav_duration(audio)
+    if isinstance(audio, str):
+        return result_response(result_id, usage["audio_seconds"], timings)
+    return Response(content=audio, media_type="audio/wav", headers={"Server-Timing": server_timing_header(timings)})
+
+# --- 自定义 BGM 上传 ---
+# Oversized requests are refused by UploadSizeLimit while they stream in. The
+# upload Starlette already spooled is hashed in place; each distinct upload
+# is copied to a named file (ffprobe/ffmpeg need a path), probed and decoded
+# to mono WAV once, and repeats of the same content reuse
+# BGM_CACHE_DIR/<sha256>.wav without any copy.
+def probe_audio(path):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "format=duration,format_name:stream=codec_type",
+         "-of", "json", path],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30,
+    )
+    info = json.loads(out.stdout or b"{}")
+    if not info.get("streams"):
+        raise ValueError("no audio stream")
+    return float(info.get("format", {}).get("duration") or 0), info.get("format", {}).get("format_name", "")
+
+def decode_bgm(src_path, digest):
+    duration, fmt = probe_audio(src_path)
+    if duration <= 0:
+        raise ValueError(f"could not determine duration ({fmt})")
+    if duration > BGM_MAX_SECONDS:
+        raise ValueError(f"BGM is {duration:.0f}s, limit is {BGM_MAX_SECONDS:.0f}s")
+    os.makedirs(BGM_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=BGM_CACHE_DIR, prefix=".tmp-", suffix=".wav")
+    os.close(fd)
+    try:
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-i", src_path, "-vn", "-ac", "1", "-ar", "24000", "-c:a", "pcm_s16le", tmp_path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=120,
+        )
+        final_path = os.path.join(BGM_CACHE_DIR, f"{digest}.wav")
+        os.replace(tmp_path, final_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    prune_bgm_cache()
+    return final_path
+
+def prune_bgm_cache():
+    entries = []
+    for entry in os.scandir(BGM_CACHE_DIR):
+        if entry.name.endswith(".wav") and not entry.name.startswith(".tmp-"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= BGM_CACHE_MB * 1024 * 1024:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+def hash_upload(f, max_bytes):
+    # (sha256 hex, size) of a spooled upload, or (None, size) once it is
+    # found to be over max_bytes. Leaves the file at the start.
+    digest = hashlib.sha256()
+    size = 0
+    f.seek(0)
+    for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+        size += len(chunk)
+        if size > max_bytes:
+            return None, size
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest(), size
+
+async def ingest_bgm_upload(upload: UploadFile) -> Optional[str]:
+    # Chunked bodies carry no Content-Length, so the size is checked here too.
+    digest, size = await asyncio.to_thread(hash_upload, upload.file, int(BGM_MAX_MB * 1024 * 1024))
+    if digest is None:
+        raise HTTPException(status_code=413, detail=f"BGM file exceeds {BGM_MAX_MB:g} MB")
+    if not size:
+        return None
+    cached = os.path.join(BGM_CACHE_DIR, f"{digest}.wav")
+    if os.path.exists(cached):
+        os.utime(cached)
+        return cached
+    # ffprobe/ffmpeg need a real path.
+    suffix = os.path.splitext(upload.filename or "")[1] or ".mp3"
+    src = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        await asyncio.to_thread(shutil.copyfileobj, upload.file, src, UPLOAD_CHUNK)
+        src.close()
+        with timed("bgm_decode"):
+            return await asyncio.to_thread(decode_bgm, src.name, digest)
+    except FileNotFoundError:
+        logging.error("ffprobe/ffmpeg not found, BGM upload ignored")
+        return None
+    except (ValueError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        detail = e.stderr.decode("utf-8", "replace")[:200] if getattr(e, "stderr", None) else str(e)
+        raise HTTPException(status_code=400, detail=f"Invalid BGM file: {detail}")
+    finally:
+        src.close()
+        os.unlink(src.name)
+
+@app.post("/tts_timing")
+def tts_timing(req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    # Same synthesis and billing as /tts, returned as JSON with the WAV in
+    # base64 plus segment/mora timings and a viseme track for lip-sync.
+    timings = start_request_timing()
+    api_key = normalize_api_key(x_api_key)
+    segment_info = []
+    with track_usage("/tts_timing", api_key, req.text, req) as usage:
+        with timed("auth"):
+            charge_for_text(db, api_key, req.text)
+        segments = parse_segments(req.text, req.speaker)
+        audio = generate_combined_audio(segments, req, new_deadline(req.timeout), segment_info)
+        with timed("auth"):
+            db.commit()
+        usage["audio_seconds"] = wav_duration(audio)
+    return JSONResponse(
+        content={
+            "media_type": "audio/wav",
+            "audio": base64.b64encode(audio).decode("ascii"),
+            "duration": round(usage["audio_seconds"], 4),
+            **build_timing(segment_info),
+        },
+        headers={"Server-Timing": server_timing_header(timings)},
+    )
 
 @app.post("/tts_custom")
 async def tts_custom(
@@ -579,19 +2568,17 @@ async def tts_custom(
     speedScale: float = Form(1.1), pitchScale: float = Form(0.0), intonationScale: float = Form(1.0),
     volumeScale: float = Form(1.0), prePhonemeLength: float = Form(0.1), postPhonemeLength: float = Form(0.1),
     outputSamplingRate: int = Form(24000), outputStereo: bool = Form(False), kana: Optional[str] = Form(None),
-    bgmEnabled: bool = Form(False), bgmVolume: float = Form(0.5), bgmFile: UploadFile = File(None),
+    bgmEnabled: bool = Form(False), bgmVolume: float = Form(0.5), bgmFile: UploadFile = File(None), result: bool = Form(False),
     x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)
 ):
-    x_api_key = normalize_api_key(x_api_key)
-    user = db.query(User).filter(User.api_key == x_api_key).first()
-    if user:
-        cost = len(text)
-        if user.balance < cost: raise HTTPException(status_code=402, detail="Insufficient balance")
-        user.balance -= cost
-    else:
-        record = db.query(APIKeyRecord).filter(APIKeyRecord.key == x_api_key).first()
-        if not record or record.credits <= 0: raise HTTPException(status_code=401, detail="Invalid key or no credits")
-        record.credits -= 1
+    timings = start_request_timing()
+    try:
+        check_sampling_rate(outputSamplingRate)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    api_key = normalize_api_key(x_api_key)
+    with timed("auth"):
+        charge_for_text(db, api_key, text)
     class Params: pass
     p = Params()
     p.speedScale = speedScale
@@ -606,25 +2593,577 @@ async def tts_custom(
     p.mode = mode
     p.bgmEnabled = bgmEnabled
     p.bgmVolume = bgmVolume
-    temp_bgm_path = None
+    p.speaker = speaker
+    p.result = result
     if bgmFile is not None:
-        content = await bgmFile.read()
-        if content:
-            suffix = os.path.splitext(bgmFile.filename or "")[1] or ".mp3"
-            tf = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
-            tf.write(content)
-            tf.close()
-            temp_bgm_path = tf.name
-            p.bgmFilePath = temp_bgm_path
-    
+        bgm_path = await ingest_bgm_upload(bgmFile)
+        if bgm_path:
+            p.bgmFilePath = bgm_path
+
+    with track_usage("/tts_custom", api_key, text, p) as usage:
+        # Rendering waits for engine slots and subprocesses; keep it off the
+        # event loop like the BGM ingest above.
+        segments = await asyncio.to_thread(parse_segments, text, speaker)
+        if wants_result(p):
+            with RESULTS.new_result() as (result_id, path):
+                await asyncio.to_thread(write_combined_audio, segments, p, path)
+            audio = RESULTS.path(result_id)
+        else:
+            audio = await asyncio.to_thread(generate_combined_audio, segments, p)
+        with timed("auth"):
+            db.commit()
+        usage["audio_seconds"] = wav_duration(audio)
+    if isinstance(audio, str):
+        return result_response(result_id, usage["audio_seconds"], timings)
+    return Response(content=audio, media_type="audio/wav", headers={"Server-Timing": server_timing_header(timings)})
+
+# --- 两段式合成：查询句柄 ---
+# /tts_query runs parse_segments + conversion + audio_query once and keeps the
+# AudioQueries in CACHE under an opaque handle (TTL-bound, and bounded by the
+# cache's own size limit). /tts_synthesize then only applies prosody
+# overrides or edited accent phrases and calls /synthesis, so slider tweaks
+# in an editing session skip conversion and audio_query entirely.
+class SynthesizeRequest(BaseModel):
+    handle: str
+    speedScale: Optional[float] = None
+    pitchScale: Optional[float] = None
+    intonationScale: Optional[float] = None
+    volumeScale: Optional[float] = None
+    prePhonemeLength: Optional[float] = None
+    postPhonemeLength: Optional[float] = None
+    pauseLength: Optional[float] = None
+    pauseLengthScale: Optional[float] = None
+    outputSamplingRate: Optional[int] = None
+    outputStereo: Optional[bool] = None
+    bgmEnabled: Optional[bool] = None
+    bgmVolume: Optional[float] = None
+    # [{"index": 0, "accent_phrases": [...]}, ...] replaces those segments'
+    # accent phrases (edited moras, accents, pauses).
+    segments: Optional[List[Dict]] = None
+    timeout: Optional[float] = None
+
+    _check_sampling_rate = validator("outputSamplingRate", allow_reuse=True)(check_sampling_rate)
+
+def build_segment_queries(segments, params, deadline):
+    # AudioQuery per non-empty segment, reusing the one cached alongside the
+    # segment's audio when it has been rendered before.
+    use_pseudo = getattr(params, "mode", "pseudo_jp") == "pseudo_jp"
+    segments = [(spk_id, text) for spk_id, text in segments if text]
+    texts = [text for _, text in segments]
+    with timed("convert"):
+        targets = convert_texts(texts) if use_pseudo else texts
+    items = []
+    for (spk_id, text), target_text in zip(segments, targets):
+        cached = CACHE.get("query:" + segment_cache_key(spk_id, target_text, params))
+        if cached is not None:
+            query = json.loads(cached)
+        else:
+            with timed("audio_query"):
+                query = build_audio_query(spk_id, target_text, params, deadline)
+        items.append({"speaker": spk_id, "text": text, "query": query})
+    return items
+
+def query_cache_key(spk_id, query):
+    return "audio:" + hashlib.sha256(json.dumps([spk_id, query], sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def synthesize_queries(items, deadline):
+    # Waves for [(speaker, query)], cached by query content and batched per
+    # style like render_segment_waves.
+    waves = []
+    pending = {}
+    for spk_id, query in items:
+        key = query_cache_key(spk_id, query)
+        wav = CACHE.get(key)
+        if wav is None:
+            pending.setdefault(spk_id, []).append((len(waves), key, query))
+        waves.append(wav)
+    for spk_id, batch_items in pending.items():
+        with timed("synthesis"):
+            batch = synthesize_batch(spk_id, [q for _, _, q in batch_items], deadline)
+        for (idx, key, _), wav in zip(batch_items, batch):
+            if wav:
+                CACHE.set(key, wav)
+            waves[idx] = wav
+    return waves
+
+def load_query_handle(handle, api_key):
+    raw = CACHE.get("handle:" + handle)
+    record = json.loads(raw) if raw is not None else None
+    if record is None or record["api_key"] != api_key:
+        raise HTTPException(status_code=404, detail="Unknown or expired query handle")
+    return record
+
+@app.post("/tts_query")
+def tts_query(req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    timings = start_request_timing()
+    api_key = normalize_api_key(x_api_key)
+    with timed("auth"):
+        # Key and balance are checked here, but billing happens per
+        # /tts_synthesize call, so the deduction is rolled back.
+        charge_for_text(db, api_key, req.text)
+        db.rollback()
+    segments = parse_segments(req.text, req.speaker)
+    items = build_segment_queries(segments, req, new_deadline(req.timeout))
+    handle = secrets.token_urlsafe(18)
+    record = {"api_key": api_key, "request": req.dict(), "segments": items}
+    CACHE.set("handle:" + handle, json.dumps(record, ensure_ascii=False).encode("utf-8"), ttl=QUERY_HANDLE_TTL)
+    return JSONResponse(
+        content={
+            "handle": handle,
+            "expires_in": QUERY_HANDLE_TTL,
+            "segments": [
+                {"index": i, "speaker": item["speaker"], "text": item["text"], "accent_phrases": item["query"]["accent_phrases"]}
+                for i, item in enumerate(items)
+            ],
+        },
+        headers={"Server-Timing": server_timing_header(timings)},
+    )
+
+@app.post("/tts_synthesize")
+def tts_synthesize(req: SynthesizeRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    timings = start_request_timing()
+    api_key = normalize_api_key(x_api_key)
+    record = load_query_handle(req.handle, api_key)
+    overrides = {k: v for k, v in req.dict(exclude={"handle", "segments"}).items() if v is not None}
+    params = TTSRequest(**{**record["request"], **overrides})
+    items = record["segments"]
+    edits = {}
+    for edit in req.segments or []:
+        idx = edit.get("index")
+        if not isinstance(idx, int) or not 0 <= idx < len(items) or not isinstance(edit.get("accent_phrases"), list):
+            raise HTTPException(status_code=400, detail=f"Invalid segment edit: {str(edit)[:100]}")
+        edits[idx] = edit["accent_phrases"]
+    queries = []
+    for idx, item in enumerate(items):
+        query = dict(item["query"])
+        for name in PROSODY_FIELDS:
+            if getattr(params, name, None) is not None:
+                query[name] = getattr(params, name)
+        if idx in edits:
+            query["accent_phrases"] = edits[idx]
+        queries.append((item["speaker"], query))
+    with track_usage("/tts_synthesize", api_key, params.text, params) as usage:
+        with timed("auth"):
+            charge_for_text(db, api_key, params.text)
+        deadline = new_deadline(params.timeout)
+        for spk_id, _ in queries:
+            STYLE_HITS[spk_id] += 1
+        audio = combine_waves(synthesize_queries(queries, deadline), params, deadline)
+        with timed("auth"):
+            db.commit()
+        usage["audio_seconds"] = wav_duration(audio)
+    # Sliding expiry: a handle stays alive while it is being edited.
+    CACHE.set("handle:" + req.handle, json.dumps(record, ensure_ascii=False).encode("utf-8"), ttl=QUERY_HANDLE_TTL)
+    return Response(content=audio, media_type="audio/wav", headers={"Server-Timing": server_timing_header(timings)})
+
+# --- 签名 GET 合成 URL ---
+# GET /tts/signed?<params>&exp=&kid=&sig= lets pages embed audio that nginx
+# and Cloudflare can cache. The query string is canonical (sorted, defaults
+# omitted, expiry rounded to SIGNED_URL_BUCKET) so the same phrase always
+# maps to the same URL, and is signed with HMAC(secret, api_key). Only
+# renders that actually happen at the origin are billed to the key.
+SIGNED_FIELDS = (
+    "text", "speaker", "mode", "kana", "outputSamplingRate", "outputStereo", "bgmEnabled", "bgmVolume",
+) + PROSODY_FIELDS
+
+def signing_key(api_key: str) -> bytes:
+    return hmac.new(URL_SIGNING_SECRET, api_key.encode("utf-8"), hashlib.sha256).digest()
+
+def canonical_query(items):
+    return urllib.parse.urlencode(sorted(items), quote_via=urllib.parse.quote)
+
+def sign_query(api_key, canonical):
+    return hmac.new(signing_key(api_key), canonical.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def query_value(value):
+    return ("true" if value else "false") if isinstance(value, bool) else str(value)
+
+def signed_etag(items):
+    # Derived from the render parameters (not kid/exp/sig), so revalidation
+    # never needs a render and every key minting the same phrase shares it.
+    content = canonical_query([(k, v) for k, v in items if k in SIGNED_FIELDS])
+    return '"' + hashlib.sha256(content.encode("utf-8")).hexdigest()[:32] + '"'
+
+@app.post("/tts/sign")
+def sign_tts_url(req: TTSRequest, request: Request, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    api_key = normalize_api_key(x_api_key)
+    require_valid_key(db, api_key)
+    record = db.query(UrlSigningKey).filter(UrlSigningKey.api_key == api_key).first()
+    if not record:
+        record = UrlSigningKey(kid=secrets.token_urlsafe(9), api_key=api_key)
+        db.add(record)
+        db.commit()
+    defaults = TTSRequest(text="", speaker=0).dict()
+    values = req.dict()
+    items = [(name, query_value(values[name])) for name in SIGNED_FIELDS
+             if values[name] is not None and (name in ("text", "speaker") or values[name] != defaults[name])]
+    expires_at = -(-(int(time.time()) + SIGNED_URL_TTL) // SIGNED_URL_BUCKET) * SIGNED_URL_BUCKET
+    items += [("exp", str(expires_at)), ("kid", record.kid)]
+    canonical = canonical_query(items)
+    path = f"/tts/signed?{canonical}&sig={sign_query(api_key, canonical)}"
+    if len(path) > SIGNED_URL_MAX_BYTES:
+        raise HTTPException(status_code=400, detail=f"Signed URL would be {len(path)} bytes, the limit is {SIGNED_URL_MAX_BYTES}; use /tts for longer text")
+    return {"path": path, "url": str(request.base_url).rstrip("/") + path, "expires_at": expires_at}
+
+@app.get("/tts/signed")
+def signed_tts(request: Request, db: Session = Depends(get_db)):
+    timings = start_request_timing()
+    items = [(k, v) for k, v in request.query_params.multi_items() if k != "sig"]
+    fields = dict(items)
+    record = db.query(UrlSigningKey).filter(UrlSigningKey.kid == fields.get("kid", "")).first()
+    sig = request.query_params.get("sig", "")
+    if not record or not hmac.compare_digest(sig, sign_query(record.api_key, canonical_query(items))):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    try:
+        expires_at = int(fields.get("exp", ""))
+    except ValueError:
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    max_age = expires_at - int(time.time())
+    if max_age <= 0:
+        raise HTTPException(status_code=403, detail="Signed URL expired")
     try:
-        segments = parse_segments(text, speaker)
-        audio = generate_combined_audio(segments, p)
+        req = TTSRequest(**{k: v for k, v in fields.items() if k in SIGNED_FIELDS})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)[:200])
+    etag = signed_etag(items)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}, immutable"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    cache_key = "signed:" + etag.strip('"')
+    audio = CACHE.get(cache_key)
+    if audio is None:
+        api_key = record.api_key
+        with track_usage("/tts/signed", api_key, req.text, req) as usage:
+            with timed("auth"):
+                charge_for_text(db, api_key, req.text)
+            segments = parse_segments(req.text, req.speaker)
+            audio = generate_combined_audio(segments, req, new_deadline())
+            if not audio:
+                raise HTTPException(status_code=500, detail="Synthesis produced no audio")
+            with timed("auth"):
+                db.commit()
+            usage["audio_seconds"] = wav_duration(audio)
+        CACHE.set(cache_key, audio, ttl=max_age)
+    headers["Server-Timing"] = server_timing_header(timings)
+    return Response(content=audio, media_type="audio/wav", headers=headers)
+
+# --- 流式合成 (WebSocket) ---
+# Sentence ends: CJK/ASCII terminators, newlines, or a period followed by
+# whitespace (so decimals like 1.5 are not split).
+SENTENCE_END_RE = re.compile(r"[。！？!?；;…\n]+|\.(?=\s)")
+STREAM_MAX_PENDING = int(os.getenv("VOICEVOX_STREAM_MAX_PENDING", "4"))
+
+def split_sentences(buffer: str):
+    sentences = []
+    start = 0
+    for m in SENTENCE_END_RE.finditer(buffer):
+        sentence = buffer[start:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    return sentences, buffer[start:]
+
+def render_stream_sentence(api_key: str, params: TTSRequest, sentence: str) -> bytes:
+    # Renders without billing: the sender charges each sentence just before
+    # sending it, so sentences a client disconnects from are never billed.
+    # The balance is still checked first (charge_for_text without a commit),
+    # so keys without credit do not get engine time.
+    db = SessionLocal()
+    try:
+        charge_for_text(db, api_key, sentence)
+    finally:
+        db.close()
+    try:
+        return generate_combined_audio(parse_segments(sentence, params.speaker), params, new_deadline(params.timeout))
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+def charge_stream_sentence(api_key: str, sentence: str):
+    db = SessionLocal()
+    try:
+        charge_for_text(db, api_key, sentence)
         db.commit()
-        return Response(content=audio, media_type="audio/wav")
     finally:
-        if temp_bgm_path and os.path.exists(temp_bgm_path):
-            os.unlink(temp_bgm_path)
+        db.close()
+
+@app.websocket("/ws/tts")
+async def tts_stream(websocket: WebSocket, api_key: Optional[str] = None):
+    # Protocol: first message is a JSON object with TTSRequest fields (text
+    # may be empty). Later messages are text chunks, either raw or as
+    # {"text": ...}; {"event": "flush"} synthesizes the buffered tail and
+    # {"event": "end"} flushes and closes once all audio has been sent.
+    # Each sentence is answered with a JSON "sentence" event followed by one
+    # binary WAV frame, strictly in input order.
+    await websocket.accept()
+    key = normalize_api_key(api_key or websocket.headers.get("x-api-key"))
+    try:
+        params = TTSRequest(**{"text": "", **json.loads(await websocket.receive_text())})
+    except WebSocketDisconnect:
+        return
+    except Exception as e:
+        await websocket.send_json({"event": "error", "detail": f"Invalid parameters: {e}"})
+        await websocket.close(code=1003)
+        return
+
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue()
+    slots = asyncio.Semaphore(STREAM_MAX_PENDING)
+
+    async def sender():
+        index = 0
+        while True:
+            item = await pending.get()
+            if item is None:
+                return index
+            sentence, started, future = item
+            try:
+                with track_usage("/ws/tts", key, sentence, params, started) as usage:
+                    audio = await future
+                    await loop.run_in_executor(None, charge_stream_sentence, key, sentence)
+                    usage["audio_seconds"] = wav_duration(audio)
+            except HTTPException as e:
+                await websocket.send_json({"event": "error", "index": index, "status": e.status_code, "detail": e.detail})
+                raise
+            finally:
+                slots.release()
+            await websocket.send_json({"event": "sentence", "index": index, "text": sentence, "bytes": len(audio)})
+            await websocket.send_bytes(audio)
+            index += 1
+
+    async def submit(sentence):
+        # False once the sender has stopped (error or closed socket): it
+        # would never release a slot again.
+        acquire = asyncio.ensure_future(slots.acquire())
+        await asyncio.wait({acquire, send_task}, return_when=asyncio.FIRST_COMPLETED)
+        if send_task.done():
+            if acquire.done() and not acquire.cancelled():
+                slots.release()
+            acquire.cancel()
+            return False
+        started = time.perf_counter()
+        future = loop.run_in_executor(None, render_stream_sentence, key, params, sentence)
+        await pending.put((sentence, started, future))
+        return True
+
+    send_task = asyncio.create_task(sender())
+    buffer = ""
+    try:
+        while not send_task.done():
+            receive = asyncio.create_task(websocket.receive_text())
+            done, _ = await asyncio.wait({receive, send_task}, return_when=asyncio.FIRST_COMPLETED)
+            if receive not in done:
+                receive.cancel()
+                break
+            raw = receive.result()
+            try:
+                msg = json.loads(raw)
+            except ValueError:
+                msg = None
+            if not isinstance(msg, dict):
+                msg = {"text": raw}
+            buffer += msg.get("text") or ""
+            sentences, buffer = split_sentences(buffer)
+            event = msg.get("event")
+            if event in ("flush", "end") and buffer.strip():
+                sentences.append(buffer.strip())
+                buffer = ""
+            for sentence in sentences:
+                if not await submit(sentence):
+                    break
+            if event == "end":
+                break
+        await pending.put(None)
+        total = await send_task
+        await websocket.send_json({"event": "done", "sentences": total})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except HTTPException:
+        await websocket.close(code=1008)
+    finally:
+        if not send_task.done():
+            send_task.cancel()
+        # Drop sentences that have not started rendering yet.
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[2].cancel()
+
+# --- 文档：分块增量渲染 ---
+# A document is versioned text split into chunks (parse_segments segments,
+# further cut into sentences). Each rendered chunk is kept on disk as
+# DOCUMENT_DIR/<hash>.wav, the hash covering speaker, text, mode and prosody,
+# so after an edit only chunks with a new hash are rendered and billed; the
+# rest are read back from disk and re-concatenated into a result. Chunks
+# that no document's latest version references are pruned by a periodic sweep.
+os.makedirs(DOCUMENT_DIR, exist_ok=True)
+
+def chunk_hash(spk_id, text, params):
+    fields = [spk_id, text, getattr(params, "mode", "pseudo_jp"), prosody_params(params), getattr(params, "kana", None) or None]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def chunk_path(digest):
+    return os.path.join(DOCUMENT_DIR, f"{digest}.wav")
+
+def document_chunks(req: TTSRequest):
+    return [
+        [chunk_hash(spk_id, sentence, req), spk_id, sentence]
+        for spk_id, sentence in sentence_segments(parse_segments(req.text, req.speaker))
+    ]
+
+def load_document(db: Session, doc_id: str, api_key: str, version: Optional[int] = None):
+    doc = db.query(Document).filter(Document.id == doc_id, Document.api_key == api_key).first()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    row = db.query(DocumentVersion).filter(
+        DocumentVersion.document_id == doc_id, DocumentVersion.version == (version or doc.version)
+    ).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return doc, row
+
+def document_state(doc, row, previous=None):
+    # `previous` (the prior version's chunk list) adds a per-chunk
+    # "changed" flag.
+    old = {digest for digest, _, _ in previous} if previous is not None else None
+    chunks = []
+    for i, (digest, spk_id, text) in enumerate(json.loads(row.chunks)):
+        chunk = {"index": i, "hash": digest, "speaker": spk_id, "text": text, "rendered": os.path.exists(chunk_path(digest))}
+        if old is not None:
+            chunk["changed"] = digest not in old
+        chunks.append(chunk)
+    return {
+        "id": doc.id,
+        "version": row.version,
+        "latest_version": doc.version,
+        "chunks": chunks,
+        "pending_chunks": sum(1 for c in chunks if not c["rendered"]),
+        "pending_chars": sum(len(c["text"]) for c in chunks if not c["rendered"]),
+    }
+
+def prune_document_chunks(db: Session):
+    # Scans every document's latest version and DOCUMENT_DIR, so it runs
+    # periodically from document_worker rather than on each edit.
+    keep = set()
+    latest = db.query(DocumentVersion).join(
+        Document, (Document.id == DocumentVersion.document_id) & (Document.version == DocumentVersion.version)
+    )
+    for row in latest:
+        keep.update(digest for digest, _, _ in json.loads(row.chunks))
+    now = time.time()
+    for entry in os.scandir(DOCUMENT_DIR):
+        try:
+            # Anything from the last hour may belong to a render in progress.
+            if entry.name[:-len(".wav")] not in keep and entry.stat().st_mtime < now - 3600:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+def document_worker():
+    while not BACKGROUND_STOP.wait(DOCUMENT_SWEEP_INTERVAL):
+        db = SessionLocal()
+        try:
+            prune_document_chunks(db)
+        except Exception as e:
+            logging.error(f"Document chunk sweep failed: {e}")
+        finally:
+            db.close()
+
+@app.on_event("startup")
+def start_document_worker():
+    threading.Thread(target=document_worker, daemon=True, name="documents").start()
+
+def store_chunk(digest, wav):
+    fd, tmp_path = tempfile.mkstemp(dir=DOCUMENT_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(wav)
+        os.replace(tmp_path, chunk_path(digest))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+def read_chunk_waves(chunks):
+    for digest, _, _ in chunks:
+        with open(chunk_path(digest), "rb") as f:
+            yield f.read()
+
+@app.post("/documents")
+def create_document(req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    api_key = normalize_api_key(x_api_key)
+    require_valid_key(db, api_key)
+    doc = Document(id=secrets.token_urlsafe(12), api_key=api_key, version=1)
+    row = DocumentVersion(document_id=doc.id, version=1, params=json.dumps(req.dict(), ensure_ascii=False),
+                          chunks=json.dumps(document_chunks(req), ensure_ascii=False))
+    db.add_all([doc, row])
+    db.commit()
+    return document_state(doc, row)
+
+@app.get("/documents/{doc_id}")
+def get_document(doc_id: str, version: Optional[int] = None, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    return document_state(*load_document(db, doc_id, normalize_api_key(x_api_key), version))
+
+@app.put("/documents/{doc_id}")
+def update_document(doc_id: str, req: TTSRequest, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    # Saves the edited text/parameters as a new version. Nothing is rendered
+    # or billed until the next /render.
+    doc, previous = load_document(db, doc_id, normalize_api_key(x_api_key))
+    params = json.dumps(req.dict(), ensure_ascii=False)
+    if params == previous.params:
+        return document_state(doc, previous, json.loads(previous.chunks))
+    doc.version += 1
+    doc.updated_at = datetime.utcnow()
+    row = DocumentVersion(document_id=doc.id, version=doc.version, params=params,
+                          chunks=json.dumps(document_chunks(req), ensure_ascii=False))
+    db.add(row)
+    db.commit()
+    return document_state(doc, row, json.loads(previous.chunks))
+
+@app.delete("/documents/{doc_id}")
+def delete_document(doc_id: str, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    doc, _ = load_document(db, doc_id, normalize_api_key(x_api_key))
+    db.query(DocumentVersion).filter(DocumentVersion.document_id == doc.id).delete()
+    db.delete(doc)
+    db.commit()
+    return {"deleted": doc_id}
+
+@app.post("/documents/{doc_id}/render")
+def render_document(doc_id: str, version: Optional[int] = None, x_api_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    # Renders and bills only the chunks missing on disk, then assembles the
+    # whole document into the result store (303 to /results/<id>).
+    timings = start_request_timing()
+    api_key = normalize_api_key(x_api_key)
+    doc, row = load_document(db, doc_id, api_key, version)
+    params = TTSRequest(**json.loads(row.params))
+    chunks = json.loads(row.chunks)
+    missing = {}
+    for digest, spk_id, text in chunks:
+        if digest not in missing and not os.path.exists(chunk_path(digest)):
+            missing[digest] = (spk_id, text)
+    missing = list(missing.items())
+    missing_text = "".join(text for _, (_, text) in missing)
+    with track_usage("/documents/render", api_key, missing_text, params) as usage:
+        if missing:
+            with timed("auth"):
+                charge_for_text(db, api_key, missing_text)
+            deadline = new_deadline(params.timeout)
+            for start in range(0, len(missing), RESULT_BATCH_SEGMENTS):
+                batch = missing[start:start + RESULT_BATCH_SEGMENTS]
+                for _, (spk_id, _) in batch:
+                    STYLE_HITS[spk_id] += 1
+                waves = render_segment_waves([segment for _, segment in batch], params, deadline)
+                for (digest, _), wav in zip(batch, waves):
+                    if not wav:
+                        raise EngineError(502, "Engine returned empty audio")
+                    store_chunk(digest, wav)
+        with RESULTS.new_result() as (result_id, path):
+            write_waves(read_chunk_waves(chunks), params, path)
+        with timed("auth"):
+            db.commit()
+        usage["audio_seconds"] = wav_duration(RESULTS.path(result_id))
+    response = result_response(result_id, usage["audio_seconds"], timings)
+    response.headers["X-Rendered-Chunks"] = str(len(missing))
+    return response
 
 # --- Payment Logic ---
 @app.post("/api/recharge/create")
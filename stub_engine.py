@@ -0,0 +1,128 @@
+import asyncio
+import io
+import os
+import random
+import time
+import wave
+import zipfile
+
+import numpy as np
+from fastapi import FastAPI, Request, Response
+
+# Minimal stand-in for the VOICEVOX engine with injected latency, for load
+# testing the adapter (adaptive concurrency, hedging, breaker) without GPUs.
+#
+#   STUB_CAPACITY=4 STUB_BASE_MS=80 uvicorn stub_engine:app --port 50021
+#   VOICEVOX_BASE_URL=http://127.0.0.1:50021 uvicorn main:app --port 8000
+#
+# Every call takes STUB_BASE_MS + STUB_PER_CHAR_MS * chars (+/- STUB_JITTER).
+# Up to STUB_CAPACITY calls run at full speed; each call beyond that slows
+# every running call by STUB_CONTENTION, so pushing past capacity lowers
+# total throughput (the latency cliff the adapter has to stay out of).
+# STUB_ERROR_RATE injects 500s. GET /stats shows what the engine sees.
+
+CAPACITY = int(os.getenv("STUB_CAPACITY", "4"))
+BASE_MS = float(os.getenv("STUB_BASE_MS", "80"))
+PER_CHAR_MS = float(os.getenv("STUB_PER_CHAR_MS", "5"))
+JITTER = float(os.getenv("STUB_JITTER", "0.1"))
+CONTENTION = float(os.getenv("STUB_CONTENTION", "0.5"))
+ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+SAMPLE_RATE = 24000
+
+app = FastAPI()
+STATS = {"running": 0, "peak_running": 0, "calls": 0, "errors": 0, "busy_seconds": 0.0}
+
+async def simulate(chars):
+    STATS["running"] += 1
+    STATS["calls"] += 1
+    STATS["peak_running"] = max(STATS["peak_running"], STATS["running"])
+    started = time.monotonic()
+    try:
+        service = (BASE_MS + PER_CHAR_MS * chars) / 1000 * random.uniform(1 - JITTER, 1 + JITTER)
+        # Re-evaluate the slowdown in small steps so it tracks the load.
+        done = 0.0
+        while done < service:
+            slowdown = 1 + CONTENTION * max(0, STATS["running"] - CAPACITY)
+            step = min(0.01, service - done)
+            await asyncio.sleep(step * slowdown)
+            done += step
+        if random.random() < ERROR_RATE:
+            STATS["errors"] += 1
+            return False
+        return True
+    finally:
+        STATS["running"] -= 1
+        STATS["busy_seconds"] += time.monotonic() - started
+
+def query_chars(query):
+    return sum(len(ap["moras"]) for ap in query.get("accent_phrases", []))
+
+def render_wav(query):
+    seconds = query.get("prePhonemeLength", 0.1) + query.get("postPhonemeLength", 0.1)
+    for ap in query.get("accent_phrases", []):
+        for mora in ap["moras"]:
+            seconds += (mora.get("consonant_length") or 0) + mora["vowel_length"]
+    seconds /= query.get("speedScale") or 1.0
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    samples = (np.sin(2 * np.pi * 220 * t) * 6000).astype("<i2")
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(samples.tobytes())
+    return buf.getvalue()
+
+@app.get("/version")
+def version():
+    return "0.0.0-stub"
+
+@app.get("/stats")
+def stats():
+    return STATS
+
+@app.get("/speakers")
+def speakers():
+    return [{
+        "name": "stub",
+        "speaker_uuid": "00000000-0000-0000-0000-000000000000",
+        "styles": [{"name": "ノーマル", "id": 3}, {"name": "ささやき", "id": 22}],
+    }]
+
+@app.post("/initialize_speaker")
+async def initialize_speaker(speaker: int):
+    await simulate(0)
+    return Response(status_code=204)
+
+@app.post("/audio_query")
+async def audio_query(text: str, speaker: int):
+    if not await simulate(len(text) // 4):
+        return Response("injected error", status_code=500)
+    moras = [
+        {"text": "ア", "consonant": None, "consonant_length": None, "vowel": "a", "vowel_length": 0.1, "pitch": 5.5}
+        for _ in text
+    ]
+    return {
+        "accent_phrases": [{"moras": moras, "accent": 1, "pause_mora": None, "is_interrogative": False}],
+        "speedScale": 1.0, "pitchScale": 0.0, "intonationScale": 1.0, "volumeScale": 1.0,
+        "prePhonemeLength": 0.1, "postPhonemeLength": 0.1, "pauseLength": None, "pauseLengthScale": 1.0,
+        "outputSamplingRate": SAMPLE_RATE, "outputStereo": False, "kana": text,
+    }
+
+@app.post("/synthesis")
+async def synthesis(speaker: int, request: Request):
+    query = await request.json()
+    if not await simulate(query_chars(query)):
+        return Response("injected error", status_code=500)
+    return Response(render_wav(query), media_type="audio/wav")
+
+@app.post("/multi_synthesis")
+async def multi_synthesis(speaker: int, request: Request):
+    queries = await request.json()
+    if not await simulate(sum(query_chars(q) for q in queries)):
+        return Response("injected error", status_code=500)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for i, query in enumerate(queries, 1):
+            zf.writestr(f"{i:03d}.wav", render_wav(query))
+    return Response(buf.getvalue(), media_type="application/zip")